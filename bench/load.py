@@ -0,0 +1,335 @@
+#!/usr/bin/env python
+
+# Load generator for the publisher's /node/update endpoint
+#
+# Runs --concurrency client processes, each posting readings from the sensors
+# in --sensors (BME680, HM3301 and multigas shapes, in turn) over a keep-alive
+# session for --duration seconds, singly or --batch at a time on
+# /node/update/batch. Reports requests/s, readings/s and latency percentiles;
+# with --influx-stats it also reports points/s reaching the stub InfluxDB,
+# and with --publisher-pid the publisher's peak RSS (master plus workers).
+#
+# With --socket the readings go over the publisher's local Unix socket (see
+# publisher/local_socket.py) instead of HTTP, one message per reading or batch.
+#
+# --save writes the results as JSON (see bench/baselines/) and --compare checks
+# them against a saved baseline, exiting 1 if any metric is more than
+# --tolerance worse.
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import socket
+import time
+
+import requests
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Metric -> True if higher is better
+compared_metrics = {
+    'readings_per_s': True,
+    'points_per_s': True,
+    'latency_ms.p50': False,
+    'latency_ms.p95': False,
+    'latency_ms.p99': False,
+    'rss_kb.max': False,
+}
+
+
+def readingHeader(sensor_type, now):
+    return {
+        "schema_version": 1,
+        "sensor_type": sensor_type,
+        "timestamp": now,
+        "local_time": time.strftime("%d-%m-%Y %H:%M:%S", time.localtime(now)),
+    }
+
+
+def bme680Reading(n):
+    reading = readingHeader("bme680", time.time())
+    reading.update({
+        "temperature_c": 21.0 + (n % 50) / 10.0,
+        "temperature_f": 69.8 + (n % 50) / 5.5,
+        "pressure": 1013.25,
+        "humidity": 40.0 + (n % 20) / 10.0,
+        "gas_resistance": 120000.0 + n % 1000,
+        "air_quality_score": 92.5,
+        "gas_score": 70.0,
+        "gas_baseline": 121000.0,
+        "gas_offset": 1000.0,
+        "hum_score": 22.5,
+        "hum_baseline": 40.0,
+        "hum_offset": 0.5,
+    })
+    return reading
+
+
+def hm3301Reading(n):
+    # One aggregated window, as particulate/app.py publishes
+    reading = readingHeader("hm3301", time.time())
+    reading.update({"window_seconds": 60.0, "frames": 60, "checksum_errors": 0, "read_errors": 0})
+    base = 5.0 + n % 30
+    for channel, scale in (('pm1_0', 0.7), ('pm2_5', 1.0), ('pm10', 1.4)):
+        for kind in ('std', 'atm'):
+            value = base * scale
+            reading["{}_{}_mean".format(channel, kind)] = value
+            reading["{}_{}_min".format(channel, kind)] = value - 1.0
+            reading["{}_{}_max".format(channel, kind)] = value + 2.0
+            reading["{}_{}_p95".format(channel, kind)] = value + 1.5
+    for size, scale in (('0_3um', 180), ('0_5um', 55), ('1_0um', 12), ('2_5um', 2), ('5_0um', 0.4), ('10um', 0.1)):
+        reading["particles_{}_mean".format(size)] = base * scale
+    reading.update({"aqi_pm2_5": 3.0 * base, "aqi_pm10": 1.2 * base, "aqi": 3.0 * base})
+    return reading
+
+
+def multigasReading(n):
+    reading = readingHeader("multigas", time.time())
+    offset = (n % 100) / 100.0
+    reading.update({
+        "co": 4.5 + offset,
+        "no2": 0.13 + offset / 100.0,
+        "nh3": 0.68 + offset / 10.0,
+        "c3h8": 560.0 + offset * 20,
+        "c4h10": 392.0 + offset * 10,
+        "ch4": 700.0 + offset * 50,
+        "h2": 0.76 + offset / 10.0,
+        "c2h5oh": 1.68 + offset / 10.0,
+    })
+    return reading
+
+
+readings = {
+    'bme680': bme680Reading,
+    'hm3301': hm3301Reading,
+    'multigas': multigasReading,
+}
+
+
+def encode(body, payload_format):
+    if payload_format == 'msgpack':
+        return msgpack.packb(body), 'application/msgpack'
+    return json.dumps(body).encode('utf-8'), 'application/json'
+
+
+def localSender(path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 512 * 1024)
+    sock.settimeout(10)
+    sock.connect(path)
+
+    def send(data):
+        sock.send(data)
+        return sock.recv(16) == b'200'
+    return send
+
+
+def worker(args):
+    url, duration, sensors, batch, payload_format, socket_path = args
+    session = requests.Session()
+    send = localSender(socket_path) if socket_path else None
+    makers = [readings[s] for s in sensors]
+    post_url = url + '/batch' if batch else url
+    latencies = []
+    errors = 0
+    sent = 0
+    n = 0
+    end = time.monotonic() + duration
+    while time.monotonic() < end:
+        if batch:
+            body = [makers[(n + i) % len(makers)](n + i) for i in range(batch)]
+        else:
+            body = makers[n % len(makers)](n)
+        data, content_type = encode(body, payload_format)
+        start = time.monotonic()
+        try:
+            if send is not None:
+                ok = send(data)
+            else:
+                ok = session.post(post_url, data=data, headers={'Content-Type': content_type}, timeout=10).status_code == 200
+            if ok:
+                sent += batch or 1
+            else:
+                errors += 1
+        except (requests.RequestException, OSError):
+            errors += 1
+        latencies.append(time.monotonic() - start)
+        n += batch or 1
+    return latencies, errors, sent
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100.0))]
+
+
+def processTree(pid):
+    pids = [pid]
+    for p in pids:
+        try:
+            tasks = os.listdir('/proc/{}/task'.format(p))
+        except OSError:
+            continue
+        for task in tasks:
+            try:
+                with open('/proc/{}/task/{}/children'.format(p, task)) as f:
+                    pids.extend(int(c) for c in f.read().split())
+            except OSError:
+                pass
+    return pids
+
+
+def rssKb(pid):
+    # VmRSS of pid and all its descendants, e.g. gunicorn's master and workers
+    total = 0
+    for p in processTree(pid):
+        try:
+            with open('/proc/{}/status'.format(p)) as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1])
+        except OSError:
+            pass
+    return total
+
+
+def getJson(url):
+    try:
+        return requests.get(url, timeout=5).json()
+    except (requests.RequestException, ValueError):
+        return None
+
+
+def waitForDrain(stats_url, timeout=30.0):
+    # Points are counted once the publisher's write queue is empty
+    end = time.monotonic() + timeout
+    while time.monotonic() < end:
+        stats = getJson(stats_url)
+        if stats is None or stats['write_pipeline']['queue_depth'] == 0:
+            break
+        time.sleep(0.2)
+    if stats is not None:
+        time.sleep(stats['write_pipeline']['flush_interval'] + 0.5)
+    return getJson(stats_url)
+
+
+def lookup(results, metric):
+    value = results
+    for key in metric.split('.'):
+        if value is None:
+            return None
+        value = value.get(key)
+    return value
+
+
+def compare(results, baseline, tolerance):
+    regressions = 0
+    print('{:<16} {:>12} {:>12} {:>9}'.format('metric', 'baseline', 'current', 'change'))
+    for metric, higher_is_better in compared_metrics.items():
+        old = lookup(baseline['results'], metric)
+        new = lookup(results, metric)
+        if not old or new is None:
+            continue
+        change = (new - old) / old
+        worse = -change if higher_is_better else change
+        flag = ''
+        if worse > tolerance:
+            flag = 'REGRESSION'
+            regressions += 1
+        print('{:<16} {:>12.1f} {:>12.1f} {:>8.1f}% {}'.format(metric, old, new, change * 100, flag))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--url', default='http://127.0.0.1:8080/node/update')
+    parser.add_argument('--sensors', default='bme680,hm3301,multigas',
+                        help='comma separated, from {}'.format(','.join(readings)))
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--duration', type=float, default=10.0)
+    parser.add_argument('--batch', type=int, default=0, help='readings per /node/update/batch post; 0 posts singly')
+    parser.add_argument('--format', default='json', choices=('json', 'msgpack'))
+    parser.add_argument('--socket', help="send over the publisher's local socket at this path instead of HTTP")
+    parser.add_argument('--influx-stats', help='stub InfluxDB /stats URL, e.g. http://127.0.0.1:8086/stats')
+    parser.add_argument('--publisher-pid', type=int, help='publisher (gunicorn master) pid for RSS')
+    parser.add_argument('--name', default='run', help='name recorded in the results')
+    parser.add_argument('--save', help='write results as JSON to this path')
+    parser.add_argument('--compare', help='baseline JSON to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='allowed fraction worse than the baseline')
+    args = parser.parse_args()
+
+    sensors = args.sensors.split(',')
+    for s in sensors:
+        if s not in readings:
+            parser.error('unknown sensor {}'.format(s))
+    if args.format == 'msgpack' and msgpack is None:
+        parser.error('msgpack is not installed')
+    base_url = args.url.split('/node/update')[0]
+
+    influx_before = getJson(args.influx_stats) if args.influx_stats else None
+    rss_samples = []
+    with multiprocessing.Pool(args.concurrency) as pool:
+        pending = pool.map_async(worker, [(args.url, args.duration, sensors, args.batch, args.format, args.socket)] * args.concurrency)
+        while not pending.ready():
+            if args.publisher_pid:
+                rss_samples.append(rssKb(args.publisher_pid))
+            pending.wait(0.5)
+        results = pending.get()
+
+    latencies = [l for r in results for l in r[0]]
+    errors = sum(r[1] for r in results)
+    sent = sum(r[2] for r in results)
+    publisher_stats = waitForDrain(base_url + '/publisher/stats')
+    inventory = getJson(base_url + '/publisher/containers')
+
+    summary = {
+        'requests': len(latencies),
+        'errors': errors,
+        'readings': sent,
+        'requests_per_s': len(latencies) / args.duration,
+        'readings_per_s': sent / args.duration,
+        'latency_ms': dict(('p{}'.format(p), percentile(latencies, p) * 1000) for p in (50, 95, 99)),
+    }
+    if influx_before is not None:
+        influx_after = getJson(args.influx_stats)
+        delta = dict((k, influx_after[k] - influx_before[k]) for k in influx_before)
+        summary['influx'] = delta
+        summary['points_per_s'] = delta['points'] / args.duration
+    if rss_samples:
+        summary['rss_kb'] = {'max': max(rss_samples), 'end': rssKb(args.publisher_pid)}
+    if publisher_stats is not None:
+        summary['write_pipeline'] = publisher_stats['write_pipeline']
+    if inventory is not None and inventory.get('refresh_duration') is not None:
+        summary['inventory_refresh_ms'] = inventory['refresh_duration'] * 1000
+
+    print('requests: {}  errors: {}  rps: {:.1f}  readings/s: {:.1f}'.format(
+        summary['requests'], errors, summary['requests_per_s'], summary['readings_per_s']))
+    print('latency ms  p50: {p50:.2f}  p95: {p95:.2f}  p99: {p99:.2f}'.format(**summary['latency_ms']))
+    if 'points_per_s' in summary:
+        print('points/s: {:.1f}  ({} writes)'.format(summary['points_per_s'], summary['influx']['writes']))
+    if 'rss_kb' in summary:
+        print('publisher RSS kB  max: {max}  end: {end}'.format(**summary['rss_kb']))
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({
+                'name': args.name,
+                'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'host': {'machine': platform.machine(), 'cpus': os.cpu_count(), 'python': platform.python_version()},
+                'config': dict((k, v) for k, v in vars(args).items() if k not in ('save', 'compare', 'publisher_pid')),
+                'results': summary,
+            }, f, indent=2, sort_keys=True)
+            f.write('\n')
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare(summary, baseline, args.tolerance):
+            raise SystemExit(1)
@@ -0,0 +1,55 @@
+#!/bin/bash
+
+# End-to-end publisher benchmark
+#
+# Starts the stub InfluxDB, the stub Docker socket and the publisher under
+# gunicorn (SERVER=flask for the development server) on local ports, runs
+# load.py against it with any extra arguments, then stops everything.
+# TRANSPORT=uds sends the readings over the publisher's local socket.
+#
+#   bench/run.sh --concurrency 8 --duration 30 --save bench/baselines/mine.json
+#   bench/run.sh --compare bench/baselines/gunicorn-mixed-c4.json
+
+set -e
+bench=$(cd "$(dirname "$0")" && pwd)
+work=$(mktemp -d)
+port=${PORT:-18080}
+influx_port=${INFLUX_PORT:-18086}
+
+cleanup() {
+    kill $(cat "$work"/*.pid 2>/dev/null) 2>/dev/null || true
+    wait 2>/dev/null || true
+    rm -rf "$work"
+}
+trap cleanup EXIT
+
+python "$bench/stub_influx.py" --port "$influx_port" > "$work/influx.log" 2>&1 &
+echo $! > "$work/influx.pid"
+python "$bench/stub_docker.py" --socket "$work/docker.sock" --latency "${DOCKER_LATENCY:-0}" > "$work/docker.log" 2>&1 &
+echo $! > "$work/docker.pid"
+sleep 1
+
+export INFLUXURL=http://127.0.0.1:$influx_port TOKEN=bench ORG=bench BUCKET=bench \
+    FRIENDLY_NAME=bench CUSTOMER_ID=bench PORT=$port \
+    DOCKER_URL=unix://$work/docker.sock SPOOL_DIR=$work/spool \
+    HEALTH_PORT=$influx_port HEALTH_PATH=/health LOCAL_SOCKET=$work/publisher.sock
+if [ "${SERVER:-gunicorn}" = "flask" ]; then
+    (cd "$bench/../publisher" && exec python app.py) > "$work/publisher.log" 2>&1 &
+else
+    (cd "$bench/../publisher" && exec gunicorn -c gunicorn.conf.py app:app) > "$work/publisher.log" 2>&1 &
+fi
+publisher=$!
+echo $publisher > "$work/publisher.pid"
+
+for i in $(seq 50); do
+    curl -sf "http://127.0.0.1:$port/publisher/health" > /dev/null && break
+    sleep 0.2
+done
+
+transport=()
+if [ "${TRANSPORT:-http}" = "uds" ]; then
+    transport=(--socket "$LOCAL_SOCKET" --format msgpack)
+fi
+
+python "$bench/load.py" --url "http://127.0.0.1:$port/node/update" \
+    --influx-stats "http://127.0.0.1:$influx_port/stats" --publisher-pid "$publisher" "${transport[@]}" "$@"
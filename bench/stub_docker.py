@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+
+# Stub Docker Engine API on a Unix socket for benchmarking the publisher
+#
+# Serves what the publisher's container inventory asks for (version, container
+# list and inspect, top, image inspect, an empty events stream) for a fixed set
+# of running sensor containers, optionally adding --latency ms to every call.
+# GET /stats returns the number of calls and their mean latency per endpoint.
+#
+#   python stub_docker.py --socket /tmp/docker.sock
+#   DOCKER_URL=unix:///tmp/docker.sock gunicorn ...
+
+import argparse
+import http.server
+import json
+import os
+import re
+import socketserver
+import threading
+import time
+
+api_version = '1.41'
+version_prefix = re.compile(r'^/v[0-9.]+')
+
+lock = threading.Lock()
+stats = {}
+containers = {}
+latency = 0.0
+
+
+def makeContainers(names):
+    for i, name in enumerate(names):
+        container_id = '{:064x}'.format(i + 1)
+        image_id = 'sha256:{:064x}'.format(0x1000 + i)
+        containers[container_id] = {
+            'Id': container_id,
+            'Name': '/' + name,
+            'Created': '2026-01-01T00:00:00.000000000Z',
+            'Image': image_id,
+            'Config': {'Hostname': container_id[:12], 'Image': 'koti-{}:0.0.1'.format(name), 'Labels': {}},
+            'State': {'Status': 'running', 'Running': True, 'Paused': False, 'Restarting': False,
+                      'Pid': 1000 + i, 'ExitCode': 0, 'StartedAt': '2026-01-01T00:00:01.000000000Z'},
+            'NetworkSettings': {'Networks': {'koti_default': {'IPAddress': '172.18.0.{}'.format(i + 2)}}},
+        }
+
+
+class StubDocker(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        start = time.monotonic()
+        if latency:
+            time.sleep(latency)
+        path = version_prefix.sub('', self.path.split('?')[0])
+        endpoint, body = self.route(path)
+        if body is None:
+            self._json(404, {'message': 'No such object: {}'.format(path)})
+        else:
+            self._json(200, body)
+        if endpoint != 'stats':
+            with lock:
+                entry = stats.setdefault(endpoint, {'calls': 0, 'total_latency': 0.0})
+                entry['calls'] += 1
+                entry['total_latency'] += time.monotonic() - start
+
+    def route(self, path):
+        parts = path.strip('/').split('/')
+        if path == '/stats':
+            with lock:
+                return 'stats', dict((k, {'calls': v['calls'], 'mean_latency': v['total_latency'] / v['calls']})
+                                     for k, v in stats.items())
+        if path in ('/version', '/_ping'):
+            return 'version', {'ApiVersion': api_version, 'Version': '20.10.0', 'MinAPIVersion': '1.12'}
+        if path == '/events':
+            return 'events', b''
+        if parts[0] == 'containers':
+            if parts[1:] == ['json']:
+                return 'containers', [{'Id': c['Id'], 'Names': [c['Name']], 'Image': c['Config']['Image'],
+                                       'State': c['State']['Status']} for c in containers.values()]
+            container = containers.get(parts[1]) if len(parts) == 3 else None
+            if container is not None and parts[2] == 'json':
+                return 'inspect', container
+            if container is not None and parts[2] == 'top':
+                return 'top', {'Titles': ['UID', 'PID', 'PPID', 'C', 'STIME', 'TTY', 'TIME', 'CMD'],
+                               'Processes': [['root', str(container['State']['Pid']), '1', '0', '00:00', '?',
+                                              '00:00:01', 'python app.py']]}
+            return 'containers', None
+        if parts[0] == 'images' and len(parts) == 3 and parts[2] == 'json':
+            for c in containers.values():
+                if c['Image'] == parts[1]:
+                    return 'images', {'Id': c['Image'], 'RepoTags': [c['Config']['Image']]}
+            return 'images', None
+        return 'other', None
+
+    def _json(self, status, body):
+        data = body if type(body) is bytes else json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def address_string(self):
+        return 'unix'
+
+    def log_message(self, format, *args):
+        pass
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--socket', default='/tmp/docker.sock')
+    parser.add_argument('--containers', default='publisher,bme680,hm3301,multigas',
+                        help='comma separated container names')
+    parser.add_argument('--latency', type=float, default=0.0, help='ms added to every call')
+    args = parser.parse_args()
+
+    makeContainers(args.containers.split(','))
+    latency = args.latency / 1000.0
+    if os.path.exists(args.socket):
+        os.unlink(args.socket)
+    server = UnixHTTPServer(args.socket, StubDocker)
+    print('Stub Docker listening on {}'.format(args.socket))
+    server.serve_forever()
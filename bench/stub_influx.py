@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+
+# Stub InfluxDB v2 server for benchmarking the publisher
+#
+# Answers /ping and /health, accepts (optionally gzip'd) line protocol on
+# /api/v2/write and counts what it received. GET /stats returns the counters.
+
+import argparse
+import gzip
+import http.server
+import json
+import threading
+
+lock = threading.Lock()
+stats = {'writes': 0, 'points': 0, 'bytes': 0}
+
+
+class StubInflux(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        if self.path == '/stats':
+            with lock:
+                body = json.dumps(stats).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        elif self.path.startswith('/health'):
+            body = b'{"status": "pass"}'
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        else:
+            self._no_content()
+
+    def do_HEAD(self):
+        self._no_content()
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+        points = len([line for line in body.split(b'\n') if line])
+        with lock:
+            stats['writes'] += 1
+            stats['points'] += points
+            stats['bytes'] += len(body)
+        self._no_content()
+
+    def _no_content(self):
+        self.send_response(204)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8086)
+    args = parser.parse_args()
+    server = http.server.ThreadingHTTPServer((args.host, args.port), StubInflux)
+    print('Stub InfluxDB listening on {}:{}'.format(args.host, args.port))
+    server.serve_forever()
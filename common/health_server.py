@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+
+# Health and metrics server for a sensor container
+#
+# SensorHealth collects what the sampling loop reports (samples taken, error
+# counts, publish latency) and, when asked, reads the I2C arbiter's per-device
+# histograms and the publisher client's backlog. serve() answers GET /health
+# with JSON and GET /metrics in the Prometheus text format from a
+# ThreadingHTTPServer on a daemon thread, so a slow scrape never holds up
+# sampling: the sampling loop only appends to a deque and bumps counters
+# under a lock, and everything else is done on the server's threads.
+#
+# /health answers 503 once no sample has been taken for stale_after seconds.
+
+import collections
+import http.server
+import json
+import threading
+import time
+
+from i2c_arbiter import buckets, new_histogram, observe
+
+
+def localTime(seconds):
+    if seconds is None:
+        return ''
+    return time.strftime("%d-%m-%Y %H:%M:%S", time.localtime(seconds))
+
+
+def labelString(labels):
+    return ','.join('{}="{}"'.format(k, v) for k, v in sorted(labels.items()))
+
+
+def histogramLines(name, labels, histogram):
+    # i2c_arbiter histograms count per bucket; Prometheus buckets are cumulative
+    lines = []
+    prefix = labelString(labels) + ',' if labels else ''
+    cumulative = 0
+    for bound, count in zip(buckets, histogram['buckets']):
+        cumulative += count
+        le = '+Inf' if bound == float('inf') else repr(bound)
+        lines.append('{}_bucket{{{}le="{}"}} {}'.format(name, prefix, le, cumulative))
+    suffix = '{{{}}}'.format(labelString(labels)) if labels else ''
+    lines.append('{}_sum{} {}'.format(name, suffix, histogram['sum']))
+    lines.append('{}_count{} {}'.format(name, suffix, histogram['count']))
+    return lines
+
+
+class SensorHealth(object):
+
+    def __init__(self, sensor_type, software_version, sample_interval, arbiter=None, publisher=None,
+                 rate_window=60, stale_after=None, counters=()):
+        self.sensor_type = sensor_type
+        self.software_version = software_version
+        self.sample_interval = sample_interval
+        self.arbiter = arbiter
+        self.publisher = publisher
+        self.stale_after = stale_after if stale_after is not None else max(3 * sample_interval, 30.0)
+        # Optional callable returning more details for /health, e.g. scheduler timing
+        self.details = None
+
+        self.started_at = time.time()
+        self.last_sample_at = None
+        self.last_publish_at = None
+        self._lock = threading.Lock()
+        self._samples = collections.deque(maxlen=rate_window)
+        # counters names the ones count() will bump, so they're reported from the start
+        self._counters = {'samples': 0, 'publish_posts': 0, 'publish_failures': 0}
+        self._counters.update((name, 0) for name in counters)
+        self._publish_latency = new_histogram()
+
+    def sample(self, count=1, counter='samples'):
+        # Samples counted under another counter, e.g. burn-in ones, keep the
+        # service from going stale but stay out of the sample rate
+        with self._lock:
+            if counter == 'samples':
+                self._samples.append((time.monotonic(), count))
+            self._counters[counter] = self._counters.get(counter, 0) + count
+            self.last_sample_at = time.time()
+
+    def count(self, name, n=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + n
+
+    def published(self, latency, ok, readings):
+        # PublisherClient on_post hook
+        with self._lock:
+            observe(self._publish_latency, latency)
+            self._counters['publish_posts'] += 1
+            if ok:
+                self.last_publish_at = time.time()
+            else:
+                self._counters['publish_failures'] += 1
+
+    def sample_rate(self):
+        with self._lock:
+            samples = list(self._samples)
+        if len(samples) < 2 or samples[-1][0] == samples[0][0]:
+            return 0.0
+        return sum(count for _, count in samples[1:]) / (samples[-1][0] - samples[0][0])
+
+    def stale(self):
+        last = self.last_sample_at if self.last_sample_at is not None else self.started_at
+        return time.time() - last > self.stale_after
+
+    def health(self):
+        with self._lock:
+            counters = dict(self._counters)
+            latency = dict(self._publish_latency)
+        health = {
+            'status': 'stale' if self.stale() else 'ok',
+            'sensor_type': self.sensor_type,
+            'software_version': self.software_version,
+            'uptime': time.time() - self.started_at,
+            'sample_rate': self.sample_rate(),
+            'target_sample_rate': 1.0 / self.sample_interval,
+            'last_sample': localTime(self.last_sample_at),
+            'last_publish': localTime(self.last_publish_at),
+            'counters': counters,
+            'publish_latency': {
+                'count': latency['count'],
+                'mean': latency['sum'] / latency['count'] if latency['count'] else 0.0,
+                'max': latency['max'],
+            },
+        }
+        if self.publisher is not None:
+            health['publish_backlog'] = len(self.publisher.buffer)
+            health['publish_buffer_size'] = self.publisher.buffer.maxlen
+        if self.arbiter is not None:
+            health['i2c'] = dict((device, {
+                'transactions': stats['transactions'],
+                'errors': stats['errors'],
+                'mean_hold': stats['hold']['sum'] / stats['hold']['count'] if stats['hold']['count'] else 0.0,
+                'max_hold': stats['hold']['max'],
+                'mean_wait': stats['wait']['sum'] / stats['wait']['count'] if stats['wait']['count'] else 0.0,
+                'max_wait': stats['wait']['max'],
+            }) for device, stats in self.arbiter.stats().items())
+        if self.details is not None:
+            health.update(self.details())
+        return health
+
+    def metrics(self):
+        labels = {'sensor_type': self.sensor_type}
+        with self._lock:
+            counters = dict(self._counters)
+            latency = dict(self._publish_latency, buckets=list(self._publish_latency['buckets']))
+        lines = [
+            '# TYPE sensor_sample_rate gauge',
+            'sensor_sample_rate{{{}}} {}'.format(labelString(labels), self.sample_rate()),
+            '# TYPE sensor_target_sample_rate gauge',
+            'sensor_target_sample_rate{{{}}} {}'.format(labelString(labels), 1.0 / self.sample_interval),
+            '# TYPE sensor_last_sample_timestamp_seconds gauge',
+            'sensor_last_sample_timestamp_seconds{{{}}} {}'.format(labelString(labels), self.last_sample_at or 0),
+        ]
+        for name, value in sorted(counters.items()):
+            lines.append('# TYPE sensor_{}_total counter'.format(name))
+            lines.append('sensor_{}_total{{{}}} {}'.format(name, labelString(labels), value))
+        lines.append('# TYPE sensor_publish_seconds histogram')
+        lines.extend(histogramLines('sensor_publish_seconds', labels, latency))
+        if self.publisher is not None:
+            lines.append('# TYPE sensor_publish_backlog gauge')
+            lines.append('sensor_publish_backlog{{{}}} {}'.format(labelString(labels), len(self.publisher.buffer)))
+        if self.arbiter is not None:
+            i2c = self.arbiter.stats()
+            for kind in ('wait', 'hold'):
+                lines.append('# TYPE sensor_i2c_{}_seconds histogram'.format(kind))
+                for device, stats in sorted(i2c.items()):
+                    device_labels = dict(labels, bus=self.arbiter.bus, device=device)
+                    lines.extend(histogramLines('sensor_i2c_{}_seconds'.format(kind), device_labels, stats[kind]))
+            for name in ('transactions', 'errors'):
+                lines.append('# TYPE sensor_i2c_{}_total counter'.format(name))
+                for device, stats in sorted(i2c.items()):
+                    device_labels = dict(labels, bus=self.arbiter.bus, device=device)
+                    lines.append('sensor_i2c_{}_total{{{}}} {}'.format(name, labelString(device_labels), stats[name]))
+        return '\n'.join(lines) + '\n'
+
+
+class HealthHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        health = self.server.health
+        if path == '/health':
+            body = health.health()
+            status = 503 if body['status'] != 'ok' else 200
+            self._send(status, json.dumps(body).encode('utf-8'), 'application/json')
+        elif path == '/metrics':
+            self._send(200, health.metrics().encode('utf-8'), 'text/plain; version=0.0.4')
+        else:
+            self._send(404, b'Not found', 'text/plain')
+
+    def _send(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(health, port=8080, host='0.0.0.0'):
+    # A port that can't be bound only costs the health endpoint, not sampling
+    try:
+        server = http.server.ThreadingHTTPServer((host, port), HealthHandler)
+    except OSError as e:
+        print('Health server could not listen on {}: {}'.format(port, e))
+        return None
+    server.daemon_threads = True
+    server.health = health
+    threading.Thread(target=server.serve_forever, name='health-server', daemon=True).start()
+    print('Health server listening on {}'.format(port))
+    return server
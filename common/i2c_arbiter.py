@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+
+# I2C bus arbiter shared by the sensor containers
+#
+# Every container that touches a bus takes an exclusive flock() on
+# <lock_dir>/<bus>.lock for each transaction, so transactions from different
+# processes never interleave. The kernel drops the lock if a holder dies.
+# A transaction can group several bus operations (e.g. write a command, then
+# read the answer) and nests, so wrapped low-level calls inside it don't
+# re-lock. After releasing, a process that comes straight back for the bus
+# yields for yield_gap seconds first, so waiters in other containers get a
+# turn instead of losing the race every time.
+#
+# Per-device wait and hold times (histograms) and error counts are kept in
+# memory and written to <lock_dir>/stats/<bus>-<device>-<pid>.json every
+# stats_interval seconds; bus_stats() merges those files.
+
+import contextlib
+import fcntl
+import json
+import os
+import threading
+import time
+
+# Histogram bucket upper bounds, in seconds
+buckets = (0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.25, 0.5, 1.0, float('inf'))
+
+
+def new_histogram():
+    return {'count': 0, 'sum': 0.0, 'max': 0.0, 'buckets': [0] * len(buckets)}
+
+
+def observe(histogram, value):
+    histogram['count'] += 1
+    histogram['sum'] += value
+    histogram['max'] = max(histogram['max'], value)
+    for i, bound in enumerate(buckets):
+        if value <= bound:
+            histogram['buckets'][i] += 1
+            break
+
+
+class BusArbiter(object):
+
+    def __init__(self, bus='i2c-1', lock_dir='/mnt/shared/i2c', yield_gap=0.001, stats_interval=10.0):
+        self.bus = bus
+        self.lock_dir = lock_dir
+        self.yield_gap = yield_gap
+        self.stats_interval = stats_interval
+
+        os.makedirs(os.path.join(lock_dir, 'stats'), exist_ok=True)
+        self._fd = os.open(os.path.join(lock_dir, '{}.lock'.format(bus)), os.O_RDWR | os.O_CREAT, 0o666)
+        # flock() doesn't exclude threads sharing the descriptor, so threads
+        # in this process queue on a lock first
+        self._thread_lock = threading.RLock()
+        self._local = threading.local()
+        self._released_at = 0.0
+        self._stats = {}
+        self._stats_lock = threading.Lock()
+        self._written_at = 0.0
+
+    @contextlib.contextmanager
+    def transaction(self, device):
+        depth = getattr(self._local, 'depth', 0)
+        if depth:
+            self._local.depth += 1
+            try:
+                yield
+            finally:
+                self._local.depth -= 1
+            return
+
+        requested = time.monotonic()
+        self._thread_lock.acquire()
+        try:
+            if requested - self._released_at < self.yield_gap:
+                time.sleep(self.yield_gap)
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            acquired = time.monotonic()
+            self._local.depth = 1
+            error = False
+            try:
+                yield
+            except Exception:
+                error = True
+                raise
+            finally:
+                self._local.depth = 0
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+                self._released_at = time.monotonic()
+                self._record(device, acquired - requested, self._released_at - acquired, error)
+        finally:
+            self._thread_lock.release()
+
+    def wrap(self, obj, device):
+        return ArbitratedDevice(self, obj, device)
+
+    def stats(self):
+        with self._stats_lock:
+            return json.loads(json.dumps(self._stats))
+
+    def write_stats(self):
+        stats = self.stats()
+        for device, device_stats in stats.items():
+            path = os.path.join(self.lock_dir, 'stats', '{}-{}-{}.json'.format(self.bus, device, os.getpid()))
+            device_stats.update({'bus': self.bus, 'device': device, 'pid': os.getpid(), 'updated_at': time.time()})
+            tmp = path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(device_stats, f)
+            os.replace(tmp, path)
+        self._written_at = time.monotonic()
+
+    def _record(self, device, wait, hold, error):
+        with self._stats_lock:
+            if device not in self._stats:
+                self._stats[device] = {'transactions': 0, 'errors': 0, 'wait': new_histogram(), 'hold': new_histogram()}
+            device_stats = self._stats[device]
+            device_stats['transactions'] += 1
+            if error:
+                device_stats['errors'] += 1
+            observe(device_stats['wait'], wait)
+            observe(device_stats['hold'], hold)
+
+        if time.monotonic() - self._written_at >= self.stats_interval:
+            try:
+                self.write_stats()
+            except OSError as e:
+                print('Could not write I2C stats: {}'.format(e))
+                self._written_at = time.monotonic()
+
+
+class ArbitratedDevice(object):
+    # Proxy that runs every method call of the wrapped bus object as one
+    # arbiter transaction, e.g. an smbus.SMBus handed to the bme680 library
+
+    def __init__(self, arbiter, obj, device):
+        self._arbiter = arbiter
+        self._obj = obj
+        self._device = device
+
+    def __getattr__(self, name):
+        attr = getattr(self._obj, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            with self._arbiter.transaction(self._device):
+                return attr(*args, **kwargs)
+        return call
+
+
+def bus_stats(lock_dir='/mnt/shared/i2c'):
+    # Per bus and device totals across every process that has written stats
+    merged = {}
+    stats_dir = os.path.join(lock_dir, 'stats')
+    for name in sorted(os.listdir(stats_dir)):
+        if not name.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(stats_dir, name)) as f:
+                stats = json.load(f)
+        except (OSError, ValueError):
+            continue
+        key = '{}/{}'.format(stats['bus'], stats['device'])
+        if key not in merged:
+            merged[key] = {'transactions': 0, 'errors': 0, 'wait': new_histogram(), 'hold': new_histogram()}
+        total = merged[key]
+        total['transactions'] += stats['transactions']
+        total['errors'] += stats['errors']
+        for kind in ('wait', 'hold'):
+            total[kind]['count'] += stats[kind]['count']
+            total[kind]['sum'] += stats[kind]['sum']
+            total[kind]['max'] = max(total[kind]['max'], stats[kind]['max'])
+            total[kind]['buckets'] = [a + b for a, b in zip(total[kind]['buckets'], stats[kind]['buckets'])]
+    return merged
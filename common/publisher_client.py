@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+
+# Client for sending readings to the publisher
+#
+# Readings go into a ring buffer and are sent over a pooled keep-alive session
+# with bounded timeouts. While the publisher is unreachable they stay in the
+# buffer (the oldest are dropped once it is full) and are sent together on
+# /node/update/batch when it comes back.
+#
+# Readings are encoded once, as MessagePack when payload_format is 'msgpack'
+# and otherwise as JSON (with orjson when it is installed). A publisher that
+# answers 415 to MessagePack is sent JSON from then on.
+#
+# With transport='uds' readings go over the publisher's Unix socket in
+# /mnt/shared (publisher/local_socket.py) on one long-lived connection, as
+# MessagePack when it is installed, and each message is acknowledged with a
+# status code. While the socket can't be reached, readings are POSTed over
+# HTTP as usual. A batch too large for one message is sent in halves, and a
+# single reading too large for one is dropped.
+#
+# Readings stay buffered only while the publisher can't take them: connection
+# errors, 5xx, 415 and 429. Any other 4xx would come back however often they
+# were resent, and a batch is refused whole for one bad reading, so a refused
+# batch is resent in halves until the bad reading is found and dropped.
+#
+# on_post, if set, is called as on_post(latency, ok, readings) after every
+# POST or socket message, e.g. with SensorHealth.published.
+
+import collections
+import errno
+import json
+import socket
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class PublisherClient(object):
+
+    def __init__(self, url, buffer_size=8640, batch_size=500, timeout=(2.0, 5.0), payload_format='json', on_post=None,
+                 transport='http', socket_path='/mnt/shared/publisher.sock', max_message=512 * 1024):
+        self.url = url
+        self.batch_url = url + '/batch'
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.payload_format = payload_format if msgpack is not None else 'json'
+        self.on_post = on_post
+        self.transport = transport
+        self.socket_path = socket_path
+        self.max_message = max_message
+
+        self.buffer = collections.deque(maxlen=buffer_size)
+        self.session = requests.Session()
+        self.session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=1))
+        self._socket = None
+        self._socket_up = True
+        # Lowered when a batch doesn't fit in one socket message
+        self._message_batch = batch_size
+        # Lowered while a refused batch is split, until the buffer is empty
+        self._split_batch = batch_size
+
+    def publish(self, reading, flush=True):
+        # With flush=False the reading waits in the buffer for a later flush()
+        if len(self.buffer) == self.buffer.maxlen:
+            print('Publish buffer full, dropping oldest reading')
+        self.buffer.append(reading)
+        if flush:
+            return self.flush()
+        return True
+
+    def flush(self):
+        while self.buffer:
+            size = min(self.batch_size, self._split_batch, len(self.buffer))
+            if self.transport == 'uds' and self._socket_up:
+                size = min(size, self._message_batch)
+            if size == 1:
+                batch = [self.buffer[0]]
+                ok = self._post(self.url, batch[0])
+            else:
+                batch = [self.buffer[i] for i in range(size)]
+                ok = self._post(self.batch_url, batch)
+            if ok is None:
+                # Resent in halves, see _failed
+                continue
+            if not ok:
+                print('Publisher unavailable, {} readings buffered'.format(len(self.buffer)))
+                return False
+            for _ in batch:
+                self.buffer.popleft()
+            if ok is True:
+                print('published {} reading(s)'.format(len(batch)))
+        self._split_batch = self.batch_size
+        return True
+
+    def encode(self, body):
+        if self.payload_format == 'msgpack':
+            return msgpack.packb(body), 'application/msgpack'
+        if orjson is not None:
+            return orjson.dumps(body), 'application/json'
+        return json.dumps(body).encode('utf-8'), 'application/json'
+
+    def _post(self, url, body):
+        if self.transport == 'uds':
+            ok = self._send(body)
+            if self._socket_up:
+                return ok
+        return self._post_http(url, body)
+
+    def _post_http(self, url, body):
+        data, content_type = self.encode(body)
+        start = time.monotonic()
+        try:
+            r = self.session.post(url, data=data, headers={'Content-Type': content_type}, timeout=self.timeout)
+        except requests.RequestException as e:
+            print(e)
+            self._posted(start, False, body)
+            return False
+        if r.status_code == 415 and self.payload_format != 'json':
+            print('Publisher does not accept {}, falling back to JSON'.format(content_type))
+            self.payload_format = 'json'
+            return self._post_http(url, body)
+        if r.status_code != 200:
+            print('Failed to publish: {}'.format(str(r.status_code)))
+            self._posted(start, False, body)
+            return self._failed(r.status_code, body)
+        self._posted(start, True, body)
+        return True
+
+    def _failed(self, status, body):
+        # False keeps the batch buffered, None resends it now in halves and
+        # 'dropped' drops it (a single reading the publisher refuses)
+        if status < 400 or status >= 500 or status in (415, 429):
+            return False
+        if type(body) is list and len(body) > 1:
+            self._split_batch = max(1, len(body) // 2)
+            return None
+        print('Publisher refused reading with {}, dropping it: {}'.format(status, body))
+        self._split_batch = self.batch_size
+        return 'dropped'
+
+    def _send(self, body):
+        # As _post_http; _socket_up is False if the socket can't be used at all
+        if msgpack is not None:
+            data = msgpack.packb(body)
+        else:
+            data = self.encode(body)[0]
+        start = time.monotonic()
+        for attempt in (0, 1):
+            try:
+                if self._socket is None:
+                    self._socket = self._connect()
+                    self._socket_up_again()
+                self._socket.send(data)
+                reply = self._socket.recv(16)
+                break
+            except OSError as e:
+                self._close()
+                if e.errno == errno.EMSGSIZE and type(body) is list and len(body) > 1:
+                    self._message_batch = max(1, len(body) // 2)
+                    return None
+                if attempt == 0 and e.errno in (errno.EPIPE, errno.ECONNRESET):
+                    # The publisher restarted since the last message
+                    continue
+                self._socket_down(e)
+                return False
+        if not reply:
+            self._close()
+            self._socket_down('connection closed')
+            return False
+        if reply != b'200':
+            print('Failed to publish: {}'.format(reply.decode('ascii', 'replace')))
+            self._posted(start, False, body)
+            return self._failed(int(reply) if reply.isdigit() else 500, body)
+        self._posted(start, True, body)
+        return True
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.max_message)
+            sock.settimeout(self.timeout[1])
+            sock.connect(self.socket_path)
+        except OSError:
+            sock.close()
+            raise
+        return sock
+
+    def _close(self):
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+
+    def _socket_down(self, reason):
+        if self._socket_up:
+            print('Publisher socket {} unavailable ({}), using HTTP'.format(self.socket_path, reason))
+        self._socket_up = False
+
+    def _socket_up_again(self):
+        if not self._socket_up:
+            print('Publisher socket {} available again'.format(self.socket_path))
+        self._socket_up = True
+
+    def _posted(self, start, ok, body):
+        if self.on_post is not None:
+            self.on_post(time.monotonic() - start, ok, len(body) if type(body) is list else 1)
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+
+# Drift-free periodic task scheduler
+#
+# Each task's deadlines are fixed multiples of its period from when it was
+# added, so time spent reading and publishing doesn't push later samples back.
+# Between deadlines the scheduler sleeps; it never polls. A task that overruns
+# skips the ticks it missed rather than running several times back to back.
+
+import heapq
+import math
+import time
+
+
+class Scheduler(object):
+
+    def __init__(self):
+        self._heap = []
+        self._tasks = {}
+        self._seq = 0
+
+    def every(self, name, period, func):
+        start = time.monotonic()
+        self._tasks[name] = {
+            'func': func,
+            'period': period,
+            'runs': 0,
+            'overruns': 0,
+            'last_duration': 0.0,
+            'max_duration': 0.0,
+            'total_duration': 0.0,
+            'last_lateness': 0.0,
+            'max_lateness': 0.0,
+        }
+        self._push(start, name)
+
+    def run(self, until=None):
+        # Runs tasks until the monotonic time `until`, or forever
+        while self._heap:
+            deadline, _, name = self._heap[0]
+            if until is not None and deadline >= until:
+                remaining = until - time.monotonic()
+                if remaining > 0:
+                    time.sleep(remaining)
+                return
+            heapq.heappop(self._heap)
+
+            now = time.monotonic()
+            if deadline > now:
+                time.sleep(deadline - now)
+
+            task = self._tasks[name]
+            started = time.monotonic()
+            try:
+                task['func']()
+            except Exception as e:
+                print('Task {} failed: {}'.format(name, e))
+            finished = time.monotonic()
+
+            self._record(task, started - deadline, finished - started)
+
+            next_deadline = deadline + task['period']
+            if next_deadline <= finished:
+                missed = math.ceil((finished - next_deadline) / task['period'])
+                task['overruns'] += missed
+                next_deadline += missed * task['period']
+            self._push(next_deadline, name)
+
+    def stats(self):
+        stats = {}
+        for name, task in self._tasks.items():
+            stats[name] = dict((k, v) for k, v in task.items() if k not in ('func', 'total_duration'))
+            stats[name]['mean_duration'] = task['total_duration'] / task['runs'] if task['runs'] else 0.0
+        return stats
+
+    def _record(self, task, lateness, duration):
+        task['runs'] += 1
+        task['last_lateness'] = lateness
+        task['max_lateness'] = max(task['max_lateness'], lateness)
+        task['last_duration'] = duration
+        task['max_duration'] = max(task['max_duration'], duration)
+        task['total_duration'] += duration
+
+    def _push(self, deadline, name):
+        self._seq += 1
+        heapq.heappush(self._heap, (deadline, self._seq, name))
@@ -1,8 +1,7 @@
 #!/usr/bin/env python
 # NOTE:
 # This sensor is on port 0x04, so not compatible with grovepi unless you load an alternate firmware
-# This is work in progress, would need logic analyzer and arduino to get working
-# Error:
+# The earlier smbus register-read version of this service failed with:
 #   Traceback (most recent call last):
 #  File "multichannel_gas_sensor.py", line 67, in <module>
 #    m= MutichannelGasSensor()
@@ -13,73 +12,177 @@
 #  File "multichannel_gas_sensor.py", line 52, in readData
 #    buffer=bus.read_i2c_block_data(self.address, cmd, 4)
 #IOError: [Errno 5] Input/output error
+# Reads now go through gas.Gas using plain I2C messages (i2c_adapter.py). Bus
+# access is serialized with the other sensor containers by i2c_arbiter, which
+# also keeps each command together with its answer, and any remaining bus
+# errors (EIO) back off instead of retrying on every sample.
 #
 # LINKS
 # http://www.seeedstudio.com/wiki/Grove_-_Multichannel_Gas_Sensor
 # https://github.com/Seeed-Studio/Mutichannel_Gas_Sensor
-import time,sys
-import RPi.GPIO as GPIO
-import smbus
-
-# use the bus that matches your raspi version
-# rev = GPIO.RPI_REVISION
-# if rev == 2 or rev == 3 or rev == 4:
-bus = smbus.SMBus(1)
-# else:
-#     bus = smbus.SMBus(0)
-
-class MutichannelGasSensor:
-    address = None
-    is_connected = 0
-    res=[0]*3
-
-    def __init__(self,address=0x5d):
-        self.address=address
-        is_connected = 0
-        if self.readR0() >= 0:
-            self.is_connected = 1
-    
-    def readR0(self):
-        rtnData = 0
-        
-        rtnData = self.readData(0x11)
-        if(rtnData >= 0):
-            self.res0[0] = rtnData
-        else:
-            return rtnData
-            
-        rtnData = self.readData(0x12)
-        if(rtnData >= 0):
-            self.res0[0] = rtnData
-        else:
-            return rtnData
-            
-        rtnData = self.readData(0x13)
-        if(rtnData >= 0):
-            self.res0[0] = rtnData
-        else:
-            return rtnData
-        return 0    
-        
-    def readData(self,cmd):
-        timeout = 0
-        buffer=[0]*4
-        checksum = 0
-        rtnData = 0
-        
-        buffer=bus.read_i2c_block_data(self.address, cmd, 4)
-        print(buffer)
-        
-        checksum = buffer[0] + buffer[1] + buffer[2]
-        if checksum != buffer[3]:
-            return -4
-        rtnData = ((buffer[1] << 8) + buffer[2])
-        
-        return rtnData
-   
-    def sendI2C(self,cmd):
-        bus.write_byte(self.address, cmd)
-
-
-if __name__ == "__main__":		
-	m= MutichannelGasSensor()
\ No newline at end of file
+import os
+import time
+from gas import Gas
+from i2c_adapter import SMBus2I2C
+from i2c_arbiter import BusArbiter
+from publisher_client import PublisherClient
+from scheduler import Scheduler
+from health_server import SensorHealth, serve
+from sim_i2c import RecordingI2C, SimGasI2C
+
+sensor_type = 'multigas'
+software_version = '0.0.1'
+schema_version = 1
+publish_path = os.getenv('PUBLISH_PATH', 'http://publisher:8080/node/update')
+publish_buffer_size = int(os.getenv('PUBLISH_BUFFER_SIZE', '8640'))
+publish_timeout = float(os.getenv('PUBLISH_TIMEOUT', '5'))
+payload_format = os.getenv('PAYLOAD_FORMAT', 'json')
+# PUBLISH_TRANSPORT=uds sends readings over the publisher's Unix socket in
+# /mnt/shared, falling back to PUBLISH_PATH while it can't be reached
+publish_transport = os.getenv('PUBLISH_TRANSPORT', 'http')
+publish_socket = os.getenv('PUBLISH_SOCKET', '/mnt/shared/publisher.sock')
+r0_file = '/mnt/shared/{}_r0.json'.format(sensor_type)
+# SENSOR_BACKEND=sim talks to sim_i2c instead of the bus, replaying SIM_TRACE
+# if set, with the sampling interval divided by SIM_SPEED. TRACE_RECORD
+# appends the real sensor's commands and answers to a trace for it.
+sensor_backend = os.getenv('SENSOR_BACKEND', 'hw')
+sim_trace = os.getenv('SIM_TRACE')
+sim_seed = os.getenv('SIM_SEED')
+sim_speed = float(os.getenv('SIM_SPEED', '1')) if sensor_backend == 'sim' else 1.0
+trace_record = os.getenv('TRACE_RECORD')
+
+i2c_bus = int(os.getenv('I2C_BUS', '1'))
+i2c_lock_dir = os.getenv('I2C_LOCK_DIR', '/mnt/shared/i2c' if sensor_backend != 'sim' else '/tmp/koti-i2c')
+gas_addr = int(os.getenv('GAS_ADDR', str(Gas.DEFAULT_I2C_ADDR)), 0)
+sample_interval = float(os.getenv('SAMPLE_INTERVAL', '10')) / sim_speed
+# Readings are sent together once this many have been taken
+publish_batch = int(os.getenv('PUBLISH_BATCH', '6'))
+# After a bus error, samples are skipped for backoff_base seconds, doubling
+# with each further error up to backoff_max
+backoff_base = float(os.getenv('BACKOFF_BASE', '1'))
+backoff_max = float(os.getenv('BACKOFF_MAX', '300'))
+# /health and /metrics are served on HEALTH_PORT, 0 turns them off
+health_port = int(os.getenv('HEALTH_PORT', '8080'))
+
+
+def localTime(seconds=None):
+    if seconds is None:
+        seconds = time.time()
+    result = time.localtime(seconds)
+    local_time = time.strftime("%d-%m-%Y %H:%M:%S", result)
+    return local_time
+
+
+class Backoff(object):
+    # Exponential backoff after consecutive bus errors
+
+    def __init__(self, base, maximum):
+        self.base = base
+        self.maximum = maximum
+        self.failures = 0
+        self.until = 0.0
+
+    def ready(self):
+        return time.monotonic() >= self.until
+
+    def failed(self):
+        delay = min(self.maximum, self.base * 2 ** self.failures)
+        self.failures += 1
+        self.until = time.monotonic() + delay
+        return delay
+
+    def succeeded(self):
+        self.failures = 0
+        self.until = 0.0
+
+
+def connect(i2c, arbiter, backoff):
+    while True:
+        try:
+            with arbiter.transaction(sensor_type):
+                return Gas(i2c, addr=gas_addr, r0_path=r0_file)
+        except OSError as e:
+            delay = backoff.failed()
+            print('Could not reach gas sensor at {}: {}, retrying in {:.1f}s'.format(hex(gas_addr), e, delay))
+            time.sleep(delay)
+
+
+def gasReading(gas, arbiter):
+    sample_time = time.time()
+    output = {}
+    output["schema_version"] = schema_version
+    output["sensor_type"] = sensor_type
+    output["timestamp"] = sample_time
+    output["local_time"] = localTime(sample_time)
+    # LED on, channel reads and LED off hold the bus once
+    with arbiter.transaction(sensor_type):
+        reading = gas.calc_all()
+    for name, value in reading._asdict().items():
+        output[name] = float(value)
+    return output
+
+
+def getSensorData():
+    arbiter = BusArbiter('i2c-{}'.format(i2c_bus), i2c_lock_dir)
+    if sensor_backend == 'sim':
+        i2c = SimGasI2C(trace=sim_trace, seed=sim_seed)
+    else:
+        i2c = SMBus2I2C(i2c_bus, arbiter=arbiter, device=sensor_type)
+        if trace_record:
+            i2c = RecordingI2C(i2c, trace_record)
+
+    publisher = PublisherClient(publish_path,
+                                buffer_size=publish_buffer_size,
+                                timeout=(min(2.0, publish_timeout), publish_timeout),
+                                payload_format=payload_format,
+                                transport=publish_transport,
+                                socket_path=publish_socket)
+    # Served while connecting too, so a sensor that never answers shows as stale
+    health = SensorHealth(sensor_type, software_version, sample_interval, arbiter=arbiter, publisher=publisher,
+                          counters=('read_errors', 'skipped_samples'))
+    publisher.on_post = health.published
+    if health_port:
+        serve(health, health_port)
+
+    backoff = Backoff(backoff_base, backoff_max)
+    gas = connect(i2c, arbiter, backoff)
+    backoff.succeeded()
+    taken = [0]
+
+    def sample():
+        if not backoff.ready():
+            health.count('skipped_samples')
+            return
+        try:
+            output = gasReading(gas, arbiter)
+        except OSError as e:
+            # EIO, EREMOTEIO (NACK or no device), ETIMEDOUT, ...: all mean
+            # the bus should be left alone for a while, as in connect()
+            health.count('read_errors')
+            delay = backoff.failed()
+            print('I2C error reading gas sensor, backing off {:.1f}s: {}'.format(delay, e))
+            return
+        backoff.succeeded()
+        health.sample()
+        print('data= {}'.format(output))
+
+        taken[0] += 1
+        flush = taken[0] % publish_batch == 0
+        try:
+            publisher.publish(output, flush=flush)
+        except Exception as e:
+            print(e)
+
+    scheduler = Scheduler()
+    health.details = lambda: {'timing': scheduler.stats()}
+    scheduler.every('gas', sample_interval, sample)
+    try:
+        scheduler.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        i2c.close()
+
+
+if __name__ == "__main__":
+    getSensorData()
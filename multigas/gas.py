@@ -1,7 +1,15 @@
+import json
+import os
+from collections import namedtuple
 from math import pow
 from time import sleep
 
 
+# Concentrations (ppm) from one calc_all(), in the order of the Gas.CO..C2H5OH
+# constants so reading[Gas.NO2] works as well as reading.no2
+GasReading = namedtuple("GasReading", ["co", "no2", "nh3", "c3h8", "c4h10", "ch4", "h2", "c2h5oh"])
+
+
 class Gas:
     DEFAULT_I2C_ADDR = 0x04
 
@@ -42,15 +50,41 @@ class Gas:
     H2 = 6
     C2H5OH = 7
 
+    # Gas -> (sensing channel: 0 NH3, 1 CO, 2 NO2, exponent, factor), giving
+    # concentration = pow(ratio[channel], exponent) * factor
+    CURVES = (
+        (1, -1.179, 4.385),  # CO
+        (2, 1.007, 1 / 6.855),  # NO2
+        (0, -1.67, 1 / 1.47),  # NH3
+        (0, -2.518, 570.164),  # C3H8
+        (0, -2.138, 398.107),  # C4H10
+        (1, -4.363, 630.957),  # CH4
+        (1, -1.8, 0.73),  # H2
+        (1, -1.552, 1.622),  # C2H5OH
+    )
+
     adcValueR0_NH3_Buf = 0
     adcValueR0_C0_Buf = 0
     adcValueR0_NO2_Buf = 0
 
-    def __init__(self, i2c, addr=DEFAULT_I2C_ADDR):
+    def __init__(self, i2c, addr=DEFAULT_I2C_ADDR, use_resall=None, r0_path=None):
         self.i2c = i2c
         self.addr = addr
+        # None: try CMD_ADC_RESALL once and keep using it if the answer is sane
+        self.use_resall = use_resall
         self.version = self.get_version()
 
+        # R0 calibration values only change on do_calibrate(), so they are
+        # read once here, kept in memory and saved to r0_path. If the EEPROM
+        # can't be read the saved copy is used instead.
+        self.r0_path = r0_path
+        self.r0 = None
+        try:
+            self.refresh_r0()
+        except OSError:
+            if not self.load_r0():
+                raise
+
     def cmd(self, cmd, nbytes=2):
         self.i2c.writeto(self.addr, bytes(cmd))
         dta = 0
@@ -103,12 +137,85 @@ class Gas:
     def led_off(self):
         self.cmd([self.CMD_CONTROL_LED, 0])
 
+    def read_r0(self):
+        return (
+            self.cmd([6, self.ADDR_USER_ADC_HN3]),
+            self.cmd([6, self.ADDR_USER_ADC_CO]),
+            self.cmd([6, self.ADDR_USER_ADC_NO2]),
+        )
+
+    def refresh_r0(self):
+        self.r0 = self.read_r0()
+        self.save_r0()
+        return self.r0
+
+    def save_r0(self):
+        if self.r0_path is None:
+            return
+        try:
+            tmp = self.r0_path + ".tmp"
+            with open(tmp, "w") as f:
+                json.dump({"addr": self.addr, "r0": list(self.r0)}, f)
+            os.replace(tmp, self.r0_path)
+        except OSError as e:
+            print("Could not save R0 values: {}".format(e))
+
+    def load_r0(self):
+        if self.r0_path is None:
+            return False
+        try:
+            with open(self.r0_path) as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if saved.get("addr") != self.addr or len(saved.get("r0", ())) != 3:
+            return False
+        self.r0 = tuple(saved["r0"])
+        print("Using saved R0 values {}".format(self.r0))
+        return True
+
+    def read_channels(self):
+        # NH3, CO and NO2 ADC values, in one transaction when the firmware
+        # supports CMD_ADC_RESALL
+        if self.use_resall is not False:
+            self.i2c.writeto(self.addr, bytes([self.CMD_ADC_RESALL]))
+            raw = self.i2c.readfrom(self.addr, 6)
+            values = tuple((raw[i] << 8) | raw[i + 1] for i in range(0, 6, 2))
+            if all(0 < v < 1023 for v in values):
+                self.use_resall = True
+                return values
+            if self.use_resall is None:
+                print("CMD_ADC_RESALL not supported, reading channels one at a time")
+                self.use_resall = False
+
+        return (
+            self.cmd([self.CH_VALUE_NH3]),
+            self.cmd([self.CH_VALUE_CO]),
+            self.cmd([self.CH_VALUE_NO2]),
+        )
+
+    def ratios(self, r0, adc):
+        return tuple(
+            an / a0 * (1023.0 - a0) / (1023.0 - an) for a0, an in zip(r0, adc)
+        )
+
+    def calc_all(self):
+        self.led_on()
+
+        ratios = self.ratios(self.r0, self.read_channels())
+        reading = GasReading(
+            *(pow(ratios[channel], exponent) * factor or -3 for channel, exponent, factor in self.CURVES)
+        )
+
+        if self.version == 2:
+            self.led_off()
+
+        return reading
+
     def calc_gas(self, gas):
         self.led_on()
 
-        A0_0 = self.cmd([6, self.ADDR_USER_ADC_HN3])
-        A0_1 = self.cmd([6, self.ADDR_USER_ADC_CO])
-        A0_2 = self.cmd([6, self.ADDR_USER_ADC_NO2])
+        A0_0, A0_1, A0_2 = self.r0
 
         An_0 = self.cmd([self.CH_VALUE_NH3])
         An_1 = self.cmd([self.CH_VALUE_CO])
@@ -179,44 +286,44 @@ class Gas:
         a2 = 0
 
         while True:
-            a0 = self.cmd(self.CH_VALUE_NH3)
-            a1 = self.cmd(self.CH_VALUE_CO)
-            a2 = self.cmd(self.CH_VALUE_NO2)
+            a0 = self.cmd([self.CH_VALUE_NH3])
+            a1 = self.cmd([self.CH_VALUE_CO])
+            a2 = self.cmd([self.CH_VALUE_NO2])
 
             print("{}\t{}\t{}".format(a0, a1, a2))
             self.led_on()
 
             cnt = 0
             for i in range(20):
-                if (a0 - self.cmd(self.CH_VALUE_NH3)) > 2 or (
-                    self.cmd(self.CH_VALUE_NH3) - a0
+                if (a0 - self.cmd([self.CH_VALUE_NH3])) > 2 or (
+                    self.cmd([self.CH_VALUE_NH3]) - a0
                 ) > 2:
                     cnt += 1
-                if (a1 - self.cmd(self.CH_VALUE_CO)) > 2 or (
-                    self.cmd(self.CH_VALUE_CO) - a1
+                if (a1 - self.cmd([self.CH_VALUE_CO])) > 2 or (
+                    self.cmd([self.CH_VALUE_CO]) - a1
                 ) > 2:
                     cnt += 1
-                if (a2 - self.cmd(self.CH_VALUE_NO2)) > 2 or (
-                    self.cmd(self.CH_VALUE_NO2) - a2
+                if (a2 - self.cmd([self.CH_VALUE_NO2])) > 2 or (
+                    self.cmd([self.CH_VALUE_NO2]) - a2
                 ) > 2:
                     cnt += 1
 
                 if cnt > 5:
                     break
 
-                sleep(1000)
+                sleep(1)
 
             self.led_off()
             if cnt <= 5:
                 break
-            delay(200)
+            sleep(0.2)
 
         print("write user adc value: ")
         print("{}\t{}\t{}".format(a0, a1, a2))
 
-        tmp = []
+        tmp = [0] * 7
 
-        tmp[0] = 7
+        tmp[0] = self.CMD_SET_R0_ADC
 
         tmp[1] = a0 >> 8
         tmp[2] = a0 & 0xFF
@@ -227,14 +334,18 @@ class Gas:
         tmp[5] = a2 >> 8
         tmp[6] = a2 & 0xFF
 
-        self.cmd(self.addr, tmp, 7)
+        self.i2c.writeto(self.addr, bytes(tmp))
+
+        self.r0 = (a0, a1, a2)
+        self.save_r0()
 
     def gas_dump(self):
-        print(self.calc_gas(self.CO), "co")
-        print(self.calc_gas(self.NO2), "no2")
-        print(self.calc_gas(self.NH3), "nh3")
-        print(self.calc_gas(self.C3H8), "c3h8")
-        print(self.calc_gas(self.C4H10), "c4h10")
-        print(self.calc_gas(self.CH4), "ch4")
-        print(self.calc_gas(self.H2), "h2")
-        print(self.calc_gas(self.C2H5OH), "c2h50h")
+        reading = self.calc_all()
+        print(reading.co, "co")
+        print(reading.no2, "no2")
+        print(reading.nh3, "nh3")
+        print(reading.c3h8, "c3h8")
+        print(reading.c4h10, "c4h10")
+        print(reading.ch4, "ch4")
+        print(reading.h2, "h2")
+        print(reading.c2h5oh, "c2h50h")
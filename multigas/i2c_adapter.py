@@ -0,0 +1,30 @@
+#!/usr/bin/env python
+
+# smbus2-backed I2C object for the Gas driver
+#
+# Gas talks to the bus through a MicroPython-style writeto/readfrom
+# interface; this provides it on Linux with plain I2C read and write messages
+# (no register byte), which is what the sensor firmware expects. With an
+# arbiter every message is its own bus transaction; callers can group several
+# in arbiter.transaction().
+
+from smbus2 import SMBus, i2c_msg
+
+
+class SMBus2I2C(object):
+
+    def __init__(self, bus=1, arbiter=None, device='multigas'):
+        self.bus = SMBus(bus)
+        if arbiter is not None:
+            self.bus = arbiter.wrap(self.bus, device)
+
+    def writeto(self, addr, buf):
+        self.bus.i2c_rdwr(i2c_msg.write(addr, list(buf)))
+
+    def readfrom(self, addr, nbytes):
+        msg = i2c_msg.read(addr, nbytes)
+        self.bus.i2c_rdwr(msg)
+        return bytes(msg)
+
+    def close(self):
+        self.bus.close()
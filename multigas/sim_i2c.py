@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+
+# Simulated I2C bus with a Grove multichannel gas sensor on it
+#
+# SimGasI2C answers the writeto/readfrom commands gas.Gas sends the way the
+# v2 firmware does. With a trace (JSON lines of {"write": [...], "read": hex}
+# as written by RecordingI2C) each command gets its recorded answers in
+# order, looping; commands the trace doesn't have, or every command without
+# a trace, get a synthetic answer: fixed R0 values and ADC readings that
+# wander around them. It never sleeps; app.py divides its sampling interval
+# by SIM_SPEED.
+
+import json
+import random
+
+from gas import Gas
+
+
+def loadTrace(path):
+    answers = {}
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                answers.setdefault(tuple(record['write']), []).append(bytes.fromhex(record['read']))
+    if not answers:
+        raise ValueError('{} has no records'.format(path))
+    return answers
+
+
+class SimGasI2C(object):
+
+    def __init__(self, trace=None, seed=None, r0=(870, 930, 210), resall=True):
+        self._answers = loadTrace(trace) if trace else {}
+        self._replayed = dict((cmd, 0) for cmd in self._answers)
+        self._random = random.Random(seed)
+        self.resall = resall
+        self.eeprom = {
+            Gas.ADDR_IS_SET: 1126,
+            Gas.ADDR_USER_ADC_HN3: r0[0],
+            Gas.ADDR_USER_ADC_CO: r0[1],
+            Gas.ADDR_USER_ADC_NO2: r0[2],
+        }
+        self.adc = list(r0)
+        self._pending = b''
+
+    def writeto(self, addr, buf):
+        cmd = tuple(buf)
+        if cmd in self._answers:
+            answers = self._answers[cmd]
+            self._pending = answers[self._replayed[cmd] % len(answers)]
+            self._replayed[cmd] += 1
+        else:
+            self._pending = self.answer(cmd)
+
+    def readfrom(self, addr, nbytes):
+        return self._pending[:nbytes].ljust(nbytes, b'\x00')
+
+    def close(self):
+        pass
+
+    def answer(self, cmd):
+        if cmd[0] == Gas.CMD_READ_EEPROM and len(cmd) > 1:
+            return self.eeprom.get(cmd[1], 0).to_bytes(2, 'big')
+        if cmd[0] in (Gas.CH_VALUE_NH3, Gas.CH_VALUE_CO, Gas.CH_VALUE_NO2):
+            return self.sample()[cmd[0] - 1].to_bytes(2, 'big')
+        if cmd[0] == Gas.CMD_ADC_RESALL and self.resall:
+            return b''.join(value.to_bytes(2, 'big') for value in self.sample())
+        if cmd[0] == Gas.CMD_SET_R0_ADC and len(cmd) >= 7:
+            self.eeprom[Gas.ADDR_USER_ADC_HN3] = (cmd[1] << 8) | cmd[2]
+            self.eeprom[Gas.ADDR_USER_ADC_CO] = (cmd[3] << 8) | cmd[4]
+            self.eeprom[Gas.ADDR_USER_ADC_NO2] = (cmd[5] << 8) | cmd[6]
+        return b''
+
+    def sample(self):
+        # NH3, CO and NO2 ADC values
+        self.adc = [min(1000, max(20, int(value + self._random.gauss(0, 3)))) for value in self.adc]
+        return self.adc
+
+
+class RecordingI2C(object):
+    # Wraps the real I2C object and appends every command with its answer to
+    # a trace that SimGasI2C can replay
+
+    def __init__(self, i2c, path):
+        self._i2c = i2c
+        self._trace = open(path, 'a')
+        self._last_write = None
+
+    def writeto(self, addr, buf):
+        self._last_write = list(buf)
+        self._i2c.writeto(addr, buf)
+
+    def readfrom(self, addr, nbytes):
+        data = self._i2c.readfrom(addr, nbytes)
+        if self._last_write is not None:
+            self._trace.write(json.dumps({'write': self._last_write, 'read': bytes(data).hex()}) + '\n')
+            self._trace.flush()
+            self._last_write = None
+        return data
+
+    def close(self):
+        self._trace.close()
+        self._i2c.close()
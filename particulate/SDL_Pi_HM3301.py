@@ -4,27 +4,111 @@
 
 
 import time
+import struct
+from array import array
 import pigpio
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 SDA = 20
 SCL = 19
 
 
 DATA_CNT = 29
 
+# Frame layout: 2 reserved bytes, sensor number, PM1.0/PM2.5/PM10 standard,
+# PM1.0/PM2.5/PM10 atmospheric, particle counts per 0.1L above
+# 0.3/0.5/1.0/2.5/5.0/10um, checksum (low byte of the sum of bytes 0-27)
+FRAME = struct.Struct('>2xH12HB')
+
+PM_CHANNELS = ('PM_1_0_conctrt_std', 'PM_2_5_conctrt_std', 'PM_10_conctrt_std',
+               'PM_1_0_conctrt_atmosph', 'PM_2_5_conctrt_atmosph', 'PM_10_conctrt_atmosph')
+COUNT_CHANNELS = ('particles_0_3um', 'particles_0_5um', 'particles_1_0um',
+                  'particles_2_5um', 'particles_5_0um', 'particles_10um')
+CHANNELS = PM_CHANNELS + COUNT_CHANNELS
+
+
+class HM3301Frame(object):
+    # One decoded frame. read_frame() refills the same record on every call.
+    # read_ok is False if the bus read failed, and then the other fields
+    # still hold the previous frame; valid is True only for a frame that was
+    # read and passed its checksum.
+    __slots__ = ('sensor_number',) + CHANNELS + ('checksum', 'read_ok', 'valid')
+
+    def __init__(self):
+        for name in self.__slots__:
+            setattr(self, name, 0)
+        self.read_ok = False
+        self.valid = False
+
+    def pm(self):
+        return (self.PM_1_0_conctrt_std, self.PM_2_5_conctrt_std, self.PM_10_conctrt_std,
+                self.PM_1_0_conctrt_atmosph, self.PM_2_5_conctrt_atmosph, self.PM_10_conctrt_atmosph)
+
+
+def decode_frames(buf, read_ok=None):
+    # Decodes and checksums every 29-byte frame in buf in one pass. Returns a
+    # dict of channel -> uint16 array holding only frames that were read and
+    # passed their checksum, plus 'frames' and 'checksum_errors' counts.
+    n = len(buf) // DATA_CNT
+    if read_ok is None:
+        read_ok = [True] * n
+
+    if numpy is not None:
+        frames = numpy.frombuffer(buf, dtype=numpy.uint8, count=n * DATA_CNT).reshape(n, DATA_CNT)
+        sums = frames[:, :DATA_CNT - 1].sum(axis=1, dtype=numpy.uint32) & 0xff
+        ok = numpy.asarray(read_ok, dtype=bool)
+        checksum_ok = sums == frames[:, DATA_CNT - 1]
+        keep = ok & checksum_ok
+        words = numpy.ascontiguousarray(frames[keep, 4:DATA_CNT - 1]).view('>u2').astype(numpy.uint16)
+        result = dict((name, words[:, i]) for i, name in enumerate(CHANNELS))
+        result['checksum_errors'] = int((ok & ~checksum_ok).sum())
+    else:
+        view = memoryview(buf)
+        columns = [array('H') for _ in CHANNELS]
+        errors = 0
+        for i, values in enumerate(FRAME.iter_unpack(view[:n * DATA_CNT])):
+            if not read_ok[i]:
+                continue
+            offset = i * DATA_CNT
+            if sum(view[offset:offset + DATA_CNT - 1]) & 0xff != values[13]:
+                errors += 1
+                continue
+            for column, value in zip(columns, values[1:13]):
+                column.append(value)
+        result = dict(zip(CHANNELS, columns))
+        result['checksum_errors'] = errors
+
+    result['frames'] = len(result[CHANNELS[0]])
+    return result
+
 
 class SDL_Pi_HM3301(object):
 
-    def __init__(self, SDA=20, SCL=19, I2C_Address =0x40, pi= None):
+    def __init__(self, SDA=20, SCL=19, I2C_Address =0x40, pi= None, arbiter=None, device='hm3301'):
 
 
 
         self.pi = pi
+        # Optional i2c_arbiter.BusArbiter; each bb_i2c_zip is one transaction
+        self.arbiter = arbiter
+        self.device = device
         self.SDA = SDA
         self.SCL = SCL
         self.I2C_Address = I2C_Address
         self.last_data = None
 
+        # Reused by every read: the bb_i2c_zip command, the raw frame and the
+        # decoded record
+        self._read_cmd = [4,self.I2C_Address,2,7,1,0x81,3, 2,6,DATA_CNT,3,0   ]
+        self._buf = bytearray(DATA_CNT)
+        self._view = memoryview(self._buf)
+        self._sum_view = self._view[:DATA_CNT-1]
+        self.frame = HM3301Frame()
+
         self.PM_1_0_conctrt_std = 0         # PM1.0 Standard particulate matter concentration Unit:ug/m3
         self.PM_2_5_conctrt_std = 0         # PM2.5 Standard particulate matter concentration Unit:ug/m3
         self.PM_10_conctrt_std = 0          # PM10  Standard particulate matter concentration Unit:ug/m3
@@ -39,31 +123,77 @@ class SDL_Pi_HM3301(object):
         self.pi.set_pull_up_down(self.SCL, pigpio.PUD_UP)
         h = self.pi.bb_i2c_open(self.SDA, self.SCL, 20000)    
 
-        (count, data) = self.pi.bb_i2c_zip(
-             self.SDA, [4, self.I2C_Address, 2,7,1, 0x80,2,7,1,0x88,3,0])
+        (count, data) = self._zip([4, self.I2C_Address, 2,7,1, 0x80,2,7,1,0x88,3,0])
         time.sleep(10.0/1000.0)
 
 
+    def _zip(self, cmd):
+        if self.arbiter is None:
+            return self.pi.bb_i2c_zip(self.SDA, cmd)
+        with self.arbiter.transaction(self.device):
+            return self.pi.bb_i2c_zip(self.SDA, cmd)
+
+
     def read_HM3301_data(self):
 
-        (count, data) = self.pi.bb_i2c_zip(
-             self.SDA, [4,self.I2C_Address,2,7,1,0x81,3, 2,6,DATA_CNT,3,0   ])
+        (count, data) = self._zip(self._read_cmd)
 
 
         return list(data)
 
 
+    def read_frame(self):
+        # Decodes into self.frame; frame.valid is False if the read or the
+        # checksum failed
+        frame = self.frame
+        (count, data) = self._zip(self._read_cmd)
+        if count != DATA_CNT:
+            frame.read_ok = False
+            frame.valid = False
+            return frame
+        frame.read_ok = True
+        self._view[:] = data
+        (frame.sensor_number,
+         frame.PM_1_0_conctrt_std, frame.PM_2_5_conctrt_std, frame.PM_10_conctrt_std,
+         frame.PM_1_0_conctrt_atmosph, frame.PM_2_5_conctrt_atmosph, frame.PM_10_conctrt_atmosph,
+         frame.particles_0_3um, frame.particles_0_5um, frame.particles_1_0um,
+         frame.particles_2_5um, frame.particles_5_0um, frame.particles_10um,
+         frame.checksum) = FRAME.unpack_from(self._buf)
+        frame.valid = (sum(self._sum_view) & 0xff) == frame.checksum
+        return frame
+
+
+    def read_burst(self, count, interval=0.0):
+        # Reads count frames back to back into one preallocated buffer.
+        # read_ok[i] is False where the bus transaction itself failed.
+        buf = bytearray(count * DATA_CNT)
+        view = memoryview(buf)
+        read_ok = [False] * count
+        for i in range(count):
+            (n, data) = self._zip(self._read_cmd)
+            if n == DATA_CNT:
+                view[i * DATA_CNT:(i + 1) * DATA_CNT] = data
+                read_ok[i] = True
+            if interval and i < count - 1:
+                time.sleep(interval)
+        return buf, read_ok
+
+
+    def get_burst(self, count, interval=0.0):
+        buf, read_ok = self.read_burst(count, interval)
+        result = decode_frames(buf, read_ok)
+        result['read_errors'] = read_ok.count(False)
+        return result
+
+
     def close(self):
         self.pi.bb_i2c_close(self.SDA)
         self.pi.stop()
 
             
     def checksum(self):
-        sum = 0
-        for i in range(DATA_CNT-1):
-            sum += self.last_data[i]
-        sum = sum & 0xff
-        return (sum==self.last_data[28])
+        # Of the frame the last get_data() read
+        return self.frame.valid
 
    
     def parse_data(self, data):
@@ -78,10 +208,16 @@ class SDL_Pi_HM3301(object):
 
 
     def get_data(self):
-        data = self.read_HM3301_data()
-        self.last_data = data
-        self.parse_data(data)
-        return list( (self.PM_1_0_conctrt_std, self.PM_2_5_conctrt_std,  self.PM_10_conctrt_std,  self.PM_1_0_conctrt_atmosph, self.PM_2_5_conctrt_atmosph, self.PM_10_conctrt_atmosph))
+        # Raises IOError rather than return the previous frame's values when
+        # the read fails; a frame that fails its checksum is returned and
+        # checksum() is False
+        frame = self.read_frame()
+        if not frame.read_ok:
+            raise IOError('HM3301 read failed')
+        self.last_data = self._buf
+        (self.PM_1_0_conctrt_std, self.PM_2_5_conctrt_std, self.PM_10_conctrt_std,
+         self.PM_1_0_conctrt_atmosph, self.PM_2_5_conctrt_atmosph, self.PM_10_conctrt_atmosph) = frame.pm()
+        return list(frame.pm())
 
 
     def print_data(self):
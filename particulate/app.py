@@ -3,15 +3,84 @@ import time
 import traceback
 import pigpio
 import os
+import collections
+from i2c_arbiter import BusArbiter
+from publisher_client import PublisherClient
+import sim_pigpio
+from health_server import SensorHealth, serve
 
-mypi = pigpio.pi()
+sensor_type = 'hm3301'
+software_version = '0.0.1'
+schema_version = 1
+publish_path = os.getenv('PUBLISH_PATH', 'http://publisher:8080/node/update')
+publish_buffer_size = int(os.getenv('PUBLISH_BUFFER_SIZE', '1440'))
+publish_timeout = float(os.getenv('PUBLISH_TIMEOUT', '5'))
+payload_format = os.getenv('PAYLOAD_FORMAT', 'json')
+# PUBLISH_TRANSPORT=uds sends readings over the publisher's Unix socket in
+# /mnt/shared, falling back to PUBLISH_PATH while it can't be reached
+publish_transport = os.getenv('PUBLISH_TRANSPORT', 'http')
+publish_socket = os.getenv('PUBLISH_SOCKET', '/mnt/shared/publisher.sock')
+# SENSOR_BACKEND=sim reads sim_pigpio instead of the sensor (no pigpiod),
+# replaying SIM_TRACE if set, with the sampling interval and window divided
+# by SIM_SPEED. TRACE_RECORD appends the real sensor's frames to a trace.
+sensor_backend = os.getenv('SENSOR_BACKEND', 'hw')
+sim_trace = os.getenv('SIM_TRACE')
+sim_seed = os.getenv('SIM_SEED')
+sim_speed = float(os.getenv('SIM_SPEED', '1')) if sensor_backend == 'sim' else 1.0
+sim_error_rate = float(os.getenv('SIM_ERROR_RATE', '0'))
+trace_record = os.getenv('TRACE_RECORD')
+# /health and /metrics are served on HEALTH_PORT, 0 turns them off
+health_port = int(os.getenv('HEALTH_PORT', '8080'))
+
+# Frames are read every sample_interval seconds and published as one
+# aggregated reading per window_seconds
+sample_interval = float(os.getenv('SAMPLE_INTERVAL', '1')) / sim_speed
+window_seconds = float(os.getenv('WINDOW_SECONDS', '60')) / sim_speed
+# The AQI is computed over the mean of the last aqi_windows windows
+aqi_windows = int(os.getenv('AQI_WINDOWS', '60'))
 
 mySDA = 21
 mySCL = 20
+# The sensor is on its own bit-banged bus, so by default it has its own lock
+# and only its timing is shared; set I2C_LOCK_BUS=i2c-1 if it is wired to the
+# hardware bus the other sensors use
+i2c_lock_bus = os.getenv('I2C_LOCK_BUS', 'bb-{}'.format(mySDA))
+i2c_lock_dir = os.getenv('I2C_LOCK_DIR', '/mnt/shared/i2c' if sensor_backend != 'sim' else '/tmp/koti-i2c')
 
-hm3301 = SDL_Pi_HM3301.SDL_Pi_HM3301(SDA=mySDA, SCL=mySCL, pi=mypi)
+# Field name prefix for each driver channel
+channel_fields = {
+    'PM_1_0_conctrt_std': 'pm1_0_std',
+    'PM_2_5_conctrt_std': 'pm2_5_std',
+    'PM_10_conctrt_std': 'pm10_std',
+    'PM_1_0_conctrt_atmosph': 'pm1_0_atm',
+    'PM_2_5_conctrt_atmosph': 'pm2_5_atm',
+    'PM_10_conctrt_atmosph': 'pm10_atm',
+    'particles_0_3um': 'particles_0_3um',
+    'particles_0_5um': 'particles_0_5um',
+    'particles_1_0um': 'particles_1_0um',
+    'particles_2_5um': 'particles_2_5um',
+    'particles_5_0um': 'particles_5_0um',
+    'particles_10um': 'particles_10um',
+}
 
-time.sleep(0.01)
+# US EPA AQI breakpoints: (concentration low, high, index low, high).
+# PM1.0 has no AQI.
+pm2_5_breakpoints = [
+    (0.0, 9.0, 0, 50),
+    (9.1, 35.4, 51, 100),
+    (35.5, 55.4, 101, 150),
+    (55.5, 125.4, 151, 200),
+    (125.5, 225.4, 201, 300),
+    (225.5, 325.4, 301, 500),
+]
+pm10_breakpoints = [
+    (0, 54, 0, 50),
+    (55, 154, 51, 100),
+    (155, 254, 101, 150),
+    (255, 354, 151, 200),
+    (355, 424, 201, 300),
+    (425, 604, 301, 500),
+]
 
 
 def startPigpiod():
@@ -19,24 +88,135 @@ def startPigpiod():
     return result 
 
 
-def getSensorData():
+def localTime(seconds=None):
+    if seconds is None:
+        seconds = time.time()
+    result = time.localtime(seconds)
+    local_time = time.strftime("%d-%m-%Y %H:%M:%S", result)
+    return local_time
+
+
+def aqi(concentration, breakpoints):
+    for c_low, c_high, i_low, i_high in breakpoints:
+        if concentration <= c_high:
+            concentration = max(concentration, c_low)
+            return round((i_high - i_low) / (c_high - c_low) * (concentration - c_low) + i_low)
+    return 500
+
+
+class RunningMean(object):
+    # Mean of the last `size` values, O(1) per update
+
+    def __init__(self, size):
+        self.values = collections.deque(maxlen=size)
+        self.total = 0.0
+
+    def update(self, value):
+        if len(self.values) == self.values.maxlen:
+            self.total -= self.values[0]
+        self.values.append(value)
+        self.total += value
+        return self.total / len(self.values)
+
+
+def windowStats(values):
+    ordered = sorted(map(int, values))
+    n = len(ordered)
+    return {
+        'mean': sum(ordered) / n,
+        'min': ordered[0],
+        'max': ordered[-1],
+        'p95': ordered[min(n - 1, int(n * 0.95))],
+    }
+
+
+def aggregate(burst, running_pm2_5, running_pm10):
+    sample_time = time.time()
+    output = {}
+    output["schema_version"] = schema_version
+    output["sensor_type"] = sensor_type
+    output["timestamp"] = sample_time
+    output["local_time"] = localTime(sample_time)
+    output["window_seconds"] = window_seconds
+    output["frames"] = burst['frames']
+    output["checksum_errors"] = burst['checksum_errors']
+    output["read_errors"] = burst['read_errors']
+
+    if burst['frames'] == 0:
+        return output
+
+    for channel in SDL_Pi_HM3301.PM_CHANNELS:
+        for stat, value in windowStats(burst[channel]).items():
+            output['{}_{}'.format(channel_fields[channel], stat)] = float(value)
+    for channel in SDL_Pi_HM3301.COUNT_CHANNELS:
+        values = burst[channel]
+        output['{}_mean'.format(channel_fields[channel])] = float(sum(map(int, values))) / len(values)
+
+    pm2_5 = running_pm2_5.update(output['pm2_5_atm_mean'])
+    pm10 = running_pm10.update(output['pm10_atm_mean'])
+    output["aqi_pm2_5"] = aqi(int(pm2_5 * 10) / 10.0, pm2_5_breakpoints)
+    output["aqi_pm10"] = aqi(int(pm10), pm10_breakpoints)
+    output["aqi"] = max(output["aqi_pm2_5"], output["aqi_pm10"])
+    return output
+
+
+def getSensorData(hm3301):
+    publisher = PublisherClient(publish_path,
+                                buffer_size=publish_buffer_size,
+                                timeout=(min(2.0, publish_timeout), publish_timeout),
+                                payload_format=payload_format,
+                                transport=publish_transport,
+                                socket_path=publish_socket)
+    running_pm2_5 = RunningMean(aqi_windows)
+    running_pm10 = RunningMean(aqi_windows)
+    frames_per_window = max(1, int(window_seconds / sample_interval))
+
+    # Samples are reported a window at a time
+    health = SensorHealth(sensor_type, software_version, sample_interval, arbiter=hm3301.arbiter,
+                          publisher=publisher, stale_after=3 * window_seconds,
+                          counters=('checksum_errors', 'read_errors'))
+    publisher.on_post = health.published
+    if health_port:
+        serve(health, health_port)
+
     try:
         while True:
-            myData = hm3301.get_data()
-            print ("data=",myData)
-            if (hm3301.checksum() != True):
-                print("Checksum Error!")
-
-            time.sleep(3)
+            burst = hm3301.get_burst(frames_per_window, sample_interval)
+            health.sample(frames_per_window)
+            health.count('checksum_errors', burst['checksum_errors'])
+            health.count('read_errors', burst['read_errors'])
+            if burst['checksum_errors'] or burst['read_errors']:
+                print("Dropped {} frames with checksum errors, {} failed reads".format(burst['checksum_errors'], burst['read_errors']))
+            output = aggregate(burst, running_pm2_5, running_pm10)
+            print("data=", output)
+            try:
+                publisher.publish(output)
+            except Exception as e:
+                print(e)
     except:
         print("Error")
         print(traceback.format_exc())
         hm3301.close()
 
 
+def connectPi():
+    if sensor_backend == 'sim':
+        return sim_pigpio.SimPi(trace=sim_trace, seed=sim_seed, error_rate=sim_error_rate)
+    if startPigpiod() != 0:
+        return None
+    time.sleep(1)
+    mypi = pigpio.pi()
+    if trace_record:
+        mypi = sim_pigpio.RecordingPi(mypi, trace_record)
+    return mypi
+
+
 if __name__ == "__main__":
-    exit_code = startPigpiod()
-    if exit_code == 0:
-        getSensorData()
+    mypi = connectPi()
+    if mypi is not None:
+        arbiter = BusArbiter(i2c_lock_bus, i2c_lock_dir)
+        hm3301 = SDL_Pi_HM3301.SDL_Pi_HM3301(SDA=mySDA, SCL=mySCL, pi=mypi, arbiter=arbiter, device=sensor_type)
+        time.sleep(0.01)
+        getSensorData(hm3301)
     else:
-        print("pigpiod not running")
\ No newline at end of file
+        print("pigpiod not running")
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+
+# Microbenchmark for the HM3301 frame decode paths
+#
+# Feeds a fixed frame through the driver without hardware and reports the
+# per-frame cost of the original get_data()/checksum() code, the current
+# get_data(), read_frame() and the burst decode_frames().
+#
+#   python bench_decode.py [frames]
+
+import sys
+import timeit
+
+import SDL_Pi_HM3301
+from SDL_Pi_HM3301 import DATA_CNT, FRAME
+
+
+class FramePi(object):
+    # Answers every bb_i2c_zip read with the same frame; the bus setup calls
+    # the driver's __init__ makes do nothing
+
+    def __init__(self):
+        frame = bytearray(FRAME.pack(1, 12, 20, 25, 11, 19, 24, 3000, 900, 150, 20, 4, 1, 0))
+        frame[DATA_CNT - 1] = sum(frame[:DATA_CNT - 1]) & 0xff
+        self.frame = frame
+
+    def set_pull_up_down(self, gpio, pud):
+        pass
+
+    def bb_i2c_open(self, sda, scl, baud):
+        return 0
+
+    def bb_i2c_zip(self, sda, cmd):
+        return (DATA_CNT, bytearray(self.frame))
+
+
+def legacy_get_data(hm3301):
+    # get_data() and checksum() as they were before read_frame()
+    (count, data) = hm3301.pi.bb_i2c_zip(
+         hm3301.SDA, [4,hm3301.I2C_Address,2,7,1,0x81,3, 2,6,DATA_CNT,3,0   ])
+    data = list(data)
+    hm3301.last_data = data
+    hm3301.parse_data(data)
+    result = list( (hm3301.PM_1_0_conctrt_std, hm3301.PM_2_5_conctrt_std,  hm3301.PM_10_conctrt_std,  hm3301.PM_1_0_conctrt_atmosph, hm3301.PM_2_5_conctrt_atmosph, hm3301.PM_10_conctrt_atmosph))
+    sum = 0
+    for i in range(DATA_CNT-1):
+        sum += hm3301.last_data[i]
+    sum = sum & 0xff
+    return result, sum == hm3301.last_data[28]
+
+
+def driver():
+    return SDL_Pi_HM3301.SDL_Pi_HM3301(pi=FramePi())
+
+
+def report(name, seconds, frames):
+    print('{:<28} {:8.2f} us/frame'.format(name, seconds / frames * 1e6))
+
+
+if __name__ == "__main__":
+    frames = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    hm3301 = driver()
+
+    report('legacy get_data+checksum', timeit.timeit(lambda: legacy_get_data(hm3301), number=frames), frames)
+    report('get_data+checksum', timeit.timeit(lambda: (hm3301.get_data(), hm3301.checksum()), number=frames), frames)
+    report('read_frame', timeit.timeit(hm3301.read_frame, number=frames), frames)
+
+    burst = bytearray(hm3301.pi.frame * 1000)
+    runs = max(1, frames // 1000)
+    decode = timeit.timeit(lambda: SDL_Pi_HM3301.decode_frames(burst), number=runs)
+    report('decode_frames ({})'.format('numpy' if SDL_Pi_HM3301.numpy is not None else 'struct'), decode, runs * 1000)
@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+
+# Simulated pigpio for running the service without the sensor or pigpiod
+#
+# SimPi has the parts of pigpio.pi() that SDL_Pi_HM3301 uses. Each read
+# returns the next 29-byte HM3301 frame of a trace (JSON lines with the frame
+# as hex, as written by RecordingPi), looping at the end, or without a trace
+# a synthetic frame with a random-walk PM2.5 and a valid checksum. A fraction
+# error_rate of frames gets a bad checksum. It never sleeps; app.py divides
+# its sampling intervals by SIM_SPEED.
+
+import json
+import random
+import struct
+
+DATA_CNT = 29
+FRAME = struct.Struct('>2xH12H')
+
+
+def loadTrace(path):
+    with open(path) as f:
+        frames = [bytes.fromhex(json.loads(line)['frame']) for line in f if line.strip()]
+    if not frames:
+        raise ValueError('{} has no frames'.format(path))
+    for frame in frames:
+        if len(frame) != DATA_CNT:
+            raise ValueError('{} has a frame of {} bytes'.format(path, len(frame)))
+    return frames
+
+
+class SimPi(object):
+
+    def __init__(self, trace=None, seed=None, error_rate=0.0):
+        self._frames = loadTrace(trace) if trace else None
+        self._index = 0
+        self._random = random.Random(seed)
+        self.error_rate = error_rate
+        self._buf = bytearray(DATA_CNT)
+        self._pm2_5 = 8.0
+
+    def set_pull_up_down(self, gpio, pud):
+        return 0
+
+    def bb_i2c_open(self, SDA, SCL, baud):
+        return 0
+
+    def bb_i2c_close(self, SDA):
+        return 0
+
+    def stop(self):
+        pass
+
+    def bb_i2c_zip(self, SDA, data):
+        # Only the frame read asks for DATA_CNT bytes; the setup write gets
+        # an empty answer
+        if DATA_CNT not in data:
+            return (0, bytearray())
+        if self._frames is not None:
+            self._buf[:] = self._frames[self._index % len(self._frames)]
+            self._index += 1
+        else:
+            self.synthesize()
+        if self.error_rate and self._random.random() < self.error_rate:
+            self._buf[DATA_CNT - 1] ^= 0xff
+        return (DATA_CNT, bytearray(self._buf))
+
+    def synthesize(self):
+        self._pm2_5 = min(300.0, max(1.0, self._pm2_5 * (1 + self._random.gauss(0, 0.05))))
+        pm1_0 = int(self._pm2_5 * 0.7)
+        pm2_5 = int(self._pm2_5)
+        pm10 = int(self._pm2_5 * 1.4)
+        counts = [int(self._pm2_5 * k) for k in (180, 55, 12, 2.0, 0.4, 0.1)]
+        FRAME.pack_into(self._buf, 0, 1, pm1_0, pm2_5, pm10, pm1_0, pm2_5, pm10, *counts)
+        self._buf[DATA_CNT - 1] = sum(self._buf[:DATA_CNT - 1]) & 0xff
+
+
+class RecordingPi(object):
+    # Wraps a real pigpio.pi() and appends every full frame read to a trace
+    # that SimPi can replay
+
+    def __init__(self, pi, path):
+        self._pi = pi
+        self._trace = open(path, 'a')
+
+    def __getattr__(self, name):
+        return getattr(self._pi, name)
+
+    def bb_i2c_zip(self, SDA, data):
+        (count, result) = self._pi.bb_i2c_zip(SDA, data)
+        if count == DATA_CNT:
+            self._trace.write(json.dumps({'frame': bytes(result).hex()}) + '\n')
+            self._trace.flush()
+        return (count, result)
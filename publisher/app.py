@@ -1,20 +1,32 @@
 #!/usr/bin/env python
 
+import atexit
 import datetime
+import math
 import time
-import json
 import os
-import requests
+import zlib
 import docker
 from dotenv import load_dotenv
 from influxdb_client import InfluxDBClient, Point, WritePrecision
 from influxdb_client.client.write_api import SYNCHRONOUS
-from flask import Flask, request
-import sys
+from flask import Flask, request, jsonify
 import logging
+from pipeline import WritePipeline
+from inventory import ContainerInventory
+from health import HealthPoller
+from spool import Spool, SpoolReplayer
+from local_socket import LocalListener
+from tsdb import ReadingCache
+import readings
+import metrics
 
 app = Flask(__name__)
 
+# Global variables
+
+load_dotenv()
+
 ### Log Level
 # DEBUG
 # INFO
@@ -22,11 +34,7 @@ app = Flask(__name__)
 # ERROR
 # CRITICAL
 
-log_level = 'INFO'
-
-# Global variables
-
-load_dotenv()
+log_level = os.getenv('LOG_LEVEL', 'INFO')
 
 influxurl = os.getenv('INFLUXURL')
 token = os.getenv('TOKEN')
@@ -39,9 +47,60 @@ node_uuid = os.getenv('NODE_UUID')
 path = os.getenv('JSON_PATH')
 logfile = '/mnt/shared/publisher.log'
 
+# Point layout
+# per_field  - one "reading" point per payload key (legacy)
+# per_sensor - one point per payload, measurement named after sensor_type
+point_layout = os.getenv('POINT_LAYOUT', 'per_field')
+
+# Keys that describe a reading rather than being measurements
+reading_meta_keys = readings.meta_keys
+
+# Container inventory
+docker_url = os.getenv('DOCKER_URL', 'unix://var/run/docker.sock')
+inventory_refresh_interval = float(os.getenv('INVENTORY_REFRESH_INTERVAL', '60'))
+inventory_use_events = os.getenv('INVENTORY_USE_EVENTS', 'true').lower() == 'true'
+
+# Container health polling
+health_port = os.getenv('HEALTH_PORT', '8080')
+health_path = os.getenv('HEALTH_PATH', '/health')
+health_poll_interval = float(os.getenv('HEALTH_POLL_INTERVAL', '30'))
+health_timeout = float(os.getenv('HEALTH_TIMEOUT', '2'))
+health_ttl = float(os.getenv('HEALTH_TTL', '90'))
+
+# Sensors on this node can send readings over a Unix socket instead of HTTP
+# (see local_socket.py); an empty LOCAL_SOCKET turns it off
+local_socket_path = os.getenv('LOCAL_SOCKET', '/mnt/shared/publisher.sock')
+local_max_message = int(os.getenv('LOCAL_MAX_MESSAGE', str(512 * 1024)))
+
+# Recent readings are kept per worker for /readings/latest and /readings/range
+# (see tsdb.py); READING_CACHE_DIR keeps them in memory-mapped files
+reading_cache_enabled = os.getenv('READING_CACHE', 'true').lower() == 'true'
+reading_cache_size = int(os.getenv('READING_CACHE_SIZE', '8640'))
+reading_cache_dir = os.getenv('READING_CACHE_DIR', '')
+reading_cache_max_series = int(os.getenv('READING_CACHE_MAX_SERIES', '512'))
+
+# Largest /node/update/batch body accepted, after decompression
+max_batch_bytes = int(os.getenv('MAX_BATCH_BYTES', str(16 * 1024 * 1024)))
+app.config['MAX_CONTENT_LENGTH'] = max_batch_bytes
+
+# Write pipeline tuning
+influx_gzip = os.getenv('INFLUX_GZIP', 'true').lower() == 'true'
+write_queue_size = int(os.getenv('WRITE_QUEUE_SIZE', '50000'))
+write_batch_size = int(os.getenv('WRITE_BATCH_SIZE', '5000'))
+write_flush_interval = float(os.getenv('WRITE_FLUSH_INTERVAL', '1.0'))
+
+# Store-and-forward spool for writes that fail
+spool_enabled = os.getenv('SPOOL_ENABLED', 'true').lower() == 'true'
+spool_dir = os.getenv('SPOOL_DIR', '/mnt/shared/spool')
+spool_segment_bytes = int(os.getenv('SPOOL_SEGMENT_BYTES', str(4 * 1024 * 1024)))
+spool_max_bytes = int(os.getenv('SPOOL_MAX_BYTES', str(256 * 1024 * 1024)))
+spool_replay_batch = int(os.getenv('SPOOL_REPLAY_BATCH', '10000'))
+spool_max_backoff = float(os.getenv('SPOOL_MAX_BACKOFF', '300'))
+
 # DB Connections
+write_api = None
 try:
-    client = InfluxDBClient(url=influxurl, token=token)
+    client = InfluxDBClient(url=influxurl, token=token, enable_gzip=influx_gzip)
     write_api = client.write_api(write_options=SYNCHRONOUS)
     ping = client.ping()
     if ping == True:
@@ -51,156 +110,339 @@ try:
 except Exception as e:
     print("Failed to connect to influxdb with error {}".format(e))
 
+# Failed batches are spooled to disk and replayed once InfluxDB is back
+spool = None
+if spool_enabled:
+    try:
+        spool = Spool(spool_dir,
+                      segment_size=spool_segment_bytes,
+                      max_bytes=spool_max_bytes,
+                      logger=app.logger)
+    except Exception as e:
+        print("Failed to open spool at {} with error {}".format(spool_dir, e))
+
+# Points are queued by /node/update and written in batches in the background
+write_pipeline = WritePipeline(write_api, org, bucket,
+                               queue_size=write_queue_size,
+                               batch_size=write_batch_size,
+                               flush_interval=write_flush_interval,
+                               spool=spool,
+                               logger=app.logger)
+write_pipeline.start()
+atexit.register(write_pipeline.close)
+
+spool_replayer = None
+if spool is not None:
+    spool_replayer = SpoolReplayer(spool, write_pipeline.write_lines,
+                                   batch_size=spool_replay_batch,
+                                   max_backoff=spool_max_backoff,
+                                   logger=app.logger)
+    spool_replayer.start()
+
 # Docker Connection
+docker_client = None
 try:
-    docker_client = docker.DockerClient(base_url='unix://var/run/docker.sock')
+    docker_client = docker.DockerClient(base_url=docker_url)
 except Exception as e:
     print("Failed to connect to docker")
 
+# Container details are refreshed in the background and served from memory
+container_inventory = ContainerInventory(docker_client,
+                                         refresh_interval=inventory_refresh_interval,
+                                         use_events=inventory_use_events,
+                                         logger=app.logger)
+container_inventory.start()
+
+# Sensor container health is polled concurrently and cached
+container_health = HealthPoller(container_inventory.containers,
+                                port=health_port,
+                                path=health_path,
+                                interval=health_poll_interval,
+                                timeout=health_timeout,
+                                ttl=health_ttl,
+                                logger=app.logger)
+if docker_client is not None:
+    container_health.start()
+
+
+reading_cache = None
+if reading_cache_enabled:
+    reading_cache = ReadingCache(capacity=reading_cache_size,
+                                 directory=reading_cache_dir or None,
+                                 max_series=reading_cache_max_series,
+                                 logger=app.logger)
+
 
 # Prep & Send Readings to InfluxDb
-def prepareReading(friendly_name,customer_id,measurement_name,measurement):
+def prepareReading(friendly_name,customer_id,measurement_name,measurement,sample_time):
     point = Point("reading")\
         .tag("friendly_name", friendly_name)\
         .tag("customer_id", customer_id)\
         .field(measurement_name, measurement)\
-        .time(datetime.datetime.utcnow(), WritePrecision.NS)
+        .time(sample_time, WritePrecision.NS)
     #insert logic for a healthcheck point
     app.logger.debug("Prepared reading: {}".format(point))
 
     return point
 
 
-def sendData(point):
-    try:
-        write_api.write(record=point, org=org, bucket=bucket)
-        app.logger.debug("Sent reading: {}".format(point))
-        status = 'written'
-    except Exception as e:
-        app.logger.error("Error sending reading: {}".format(e))
-        status = 'failed'
-    
-    return status
+def prepareSensorReading(friendly_name,customer_id,payload):
+    point = Point(payload['sensor_type'])\
+        .tag("friendly_name", friendly_name)\
+        .tag("customer_id", customer_id)\
+        .time(sampleTime(payload), WritePrecision.NS)
+    for key in payload:
+        if key not in reading_meta_keys:
+            point.field(key, payload[key])
+    app.logger.debug("Prepared reading: {}".format(point))
+
+    return point
+
+
+def sampleSeconds(payload):
+    # Prefer the sensor's epoch timestamp, then its local_time string
+    if 'timestamp' in payload:
+        return float(payload['timestamp'])
+    if 'local_time' in payload:
+        try:
+            return time.mktime(time.strptime(payload['local_time'], "%d-%m-%Y %H:%M:%S"))
+        except (TypeError, ValueError):
+            pass
+    return time.time()
+
+
+def sampleTime(payload):
+    return datetime.datetime.fromtimestamp(sampleSeconds(payload), tz=datetime.timezone.utc)
+
+
+def preparePoints(payload):
+    if point_layout == 'per_sensor':
+        return [prepareSensorReading(friendly_name,customer_id,payload)]
+
+    points = []
+    sample_time = sampleTime(payload)
+    for key in payload:
+
+        if key not in reading_meta_keys:
+            app.logger.debug('Preparing point for {}'.format(key))
+            measurement_name = '{}-{}'.format(payload['sensor_type'],key)
+            measurement = payload[key]
+
+            points.append(prepareReading(friendly_name,customer_id,measurement_name,measurement,sample_time))
+    return points
 
 
 def getContainers():
-    container_list = docker_client.containers.list(all)
-    list = []
-    for c in container_list:
-        list.append(c.attrs)
-    container_details = []  
-    for c in list:
-        cont = docker_client.containers.get(c['Id'])
-        top_titles = cont.top().pop('Titles')
-        top_proc = cont.top().pop('Processes')
-        processes = []
-        for p in top_proc:
-            process = dict(zip(top_titles, p))
-            processes.append(process)
-        
-        #print(processes)
-        container = {}
-        image_attrs = cont.image.attrs
-        container['id'] = cont.id
-        container['name'] = cont.name
-        container['hostname'] = c['Config']['Hostname']
-        container['status'] = cont.status
-        container['state'] = c['State']
-        container['image_tags'] = image_attrs['RepoTags']
-        container['created'] = c['Created']
-        container['running_processes'] = processes
-        container['networks'] = c['NetworkSettings']
-        #print(container)
-        container_details.append(container)
-    return container_details
+    return container_inventory.containers()
 
 def getHealthData(container_details):
+    health = container_health.results()
     for c in container_details:
-        cont_name = c['name']
-        health_port = '8080'
-        health_path = '/health'
-        try:
-            response = requests.get('http://{}:{}{}'.format(cont_name,health_port,health_path))
-            if response.status_code == 200:
-                c['health_data'] = response.json()
-            else:
-                print('idk')
-        except Exception as e:
-            print(e)
+        if c['name'] in health:
+            c['health_data'] = health[c['name']]
     return container_details
 
 
+def cacheReading(payload):
+    if reading_cache is not None:
+        reading_cache.add(payload['sensor_type'], sampleSeconds(payload), payload)
+
+
 def publish(payload):
-    while True:
-        container_details = getContainers()
-
-        app.logger.debug('Payload received: {}'.format(payload))
-        
-        for key in payload:
-        
-            if key != 'sensor_type' and key != 'local_time':
-        
-                try:
-                    app.logger.debug('Preparing point for {}'.format(key))
-                    measurement_name = '{}-{}'.format(payload['sensor_type'],key)
-                    measurement = payload[key]
-                    
-                    point = prepareReading(friendly_name,customer_id,measurement_name,measurement)
-                    try: 
-                        result = sendData(point)
-                    except Exception as e:
-                        print('Failed to sendData {}'.format(e))
-                    
-                    if result == 'written':
-                        status = 'published'
-                    else:
-                        status = 'failed'
-
-            
-                except Exception as e:
-                    print("************************************************************************************")
-                    print("************************************************************************************")
-                    print("Failure... with error {}".format(e))
-                    print("************************************************************************************")
-                    print("************************************************************************************")
-                    pass
-                
-        
-                if status == 'published':
-                    continue
-                else:
-                    return 'failed'
-        
-        return 'published'
+    app.logger.debug('Payload received: {}'.format(payload))
+
+    points = preparePoints(payload)
+    metrics.countReadings(payload['sensor_type'], len(points))
+    if write_pipeline.enqueue(points):
+        # Only once queued: a reading that fails here is sent again
+        cacheReading(payload)
+        return 'queued'
+    else:
+        app.logger.warning('Write queue full, dropped {} points'.format(len(points)))
+        return 'failed'
+
+
+def publishBatch(payloads):
+    app.logger.debug('Batch received: {} readings'.format(len(payloads)))
+
+    points = []
+    # Counted once per sensor_type rather than once per reading
+    counts = {}
+    for payload in payloads:
+        prepared = preparePoints(payload)
+        points.extend(prepared)
+        count, prepared_points = counts.get(payload['sensor_type'], (0, 0))
+        counts[payload['sensor_type']] = (count + 1, prepared_points + len(prepared))
+    for sensor_type, (count, prepared_points) in counts.items():
+        metrics.countReadings(sensor_type, prepared_points, count)
+    if write_pipeline.enqueue(points):
+        for payload in payloads:
+            cacheReading(payload)
+        return 'queued'
+    else:
+        app.logger.warning('Write queue full, dropped {} points'.format(len(points)))
+        return 'failed'
+
+
+def readBatchBody():
+    body = request.get_data()
+    if request.headers.get('Content-Encoding') == 'gzip':
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        body = decompressor.decompress(body, max_batch_bytes)
+        if decompressor.unconsumed_tail:
+            raise ValueError('batch larger than {} bytes'.format(max_batch_bytes))
+    elif len(body) > max_batch_bytes:
+        raise ValueError('batch larger than {} bytes'.format(max_batch_bytes))
+    return body
 
 
 @app.route("/node/update", methods=["POST"])
+@metrics.IngestTimer('node_update')
 def nodeUpdate():
     content_type = request.headers.get('Content-Type')
-    if (content_type == 'application/json'):
-        payload = request.json
-        if type(payload) is str:
-                payload = payload.replace("\'", "\"")
-                payload = json.loads(payload)
-        try:
-            result = publish(payload)
-            
-        except Exception as e:
-            print(e)
-            return "Failed", 500
-        
-        if result == 'published':
-            return "Ack", 200
-        else:
-            return "Failed", 500
-        
-    else: 
-        return 'Content-Type: {} not supported!'.format(content_type)
+    try:
+        payload = readings.decode(request.mimetype, request.get_data())
+        if payload is None:
+            return 'Content-Type: {} not supported!'.format(content_type), 415
+        payload = readings.validateReading(payload)
+    except ValueError as e:
+        return 'Bad reading: {}'.format(e), 400
+
+    try:
+        result = publish(payload)
+
+    except Exception as e:
+        print(e)
+        return "Failed", 500
+
+    if result == 'queued':
+        return "Ack", 200
+    else:
+        return "Failed", 500
+
+@app.route("/node/update/batch", methods=["POST"])
+@metrics.IngestTimer('node_update_batch')
+def nodeUpdateBatch():
+    try:
+        payloads = readings.decodeBatch(request.mimetype, readBatchBody())
+    except (ValueError, zlib.error) as e:
+        return 'Bad batch: {}'.format(e), 400
+    if payloads is None:
+        return 'Content-Type: {} not supported!'.format(request.headers.get('Content-Type')), 415
+
+    try:
+        result = publishBatch(payloads)
+    except Exception as e:
+        print(e)
+        return "Failed", 500
+
+    if result == 'queued':
+        return jsonify({"accepted": len(payloads)}), 200
+    else:
+        return "Failed", 500
+
+@metrics.IngestTimer('local')
+def localUpdate(body):
+    # A reading or a list of readings from the local socket
+    mimetype = 'application/json' if body[:1] in (b'{', b'[') else 'application/msgpack'
+    try:
+        payloads = readings.decodeBatch(mimetype, body)
+    except ValueError as e:
+        return 'Bad reading: {}'.format(e), 400
+    if payloads is None:
+        return 'MessagePack not supported', 415
+
+    if publishBatch(payloads) == 'queued':
+        return 'Ack', 200
+    else:
+        return 'Failed', 500
+
+local_listener = None
+if local_socket_path:
+    local_listener = LocalListener(local_socket_path, localUpdate,
+                                   max_message=local_max_message,
+                                   logger=app.logger)
+    try:
+        local_listener.start()
+    except OSError as e:
+        print("Failed to listen on {} with error {}".format(local_socket_path, e))
+        local_listener = None
 
 @app.route("/publisher/health")
 def publisherHealth():
     return "healthy", 200
 
+@app.route("/publisher/containers")
+def publisherContainers():
+    return jsonify(container_inventory.snapshot()), 200
+
+@app.route("/publisher/containers/health")
+def publisherContainersHealth():
+    return jsonify(container_health.results()), 200
+
+@app.route("/publisher/stats")
+def publisherStats():
+    stats = {"write_pipeline": write_pipeline.stats()}
+    if spool is not None:
+        stats["spool"] = spool.stats()
+        stats["spool"].update(spool_replayer.stats())
+    if local_listener is not None:
+        stats["local_socket"] = local_listener.stats()
+    if reading_cache is not None:
+        stats["reading_cache"] = reading_cache.stats()
+    return jsonify(stats), 200
+
+def floatArg(name, default=None):
+    value = request.args.get(name)
+    if value is None or value == '':
+        return default
+    value = float(value)
+    if not math.isfinite(value):
+        raise ValueError('{} must be finite'.format(name))
+    return value
+
+@app.route("/readings/latest")
+def readingsLatest():
+    if reading_cache is None:
+        return "Reading cache disabled", 404
+    return jsonify(reading_cache.latest(request.args.get('measurement'), request.args.get('field'))), 200
+
+@app.route("/readings/range")
+def readingsRange():
+    # measurement and field are required; start and end are epoch seconds,
+    # defaulting to the last hour. step (seconds) or buckets (a count)
+    # downsamples to min/max/mean per bucket.
+    if reading_cache is None:
+        return "Reading cache disabled", 404
+    measurement = request.args.get('measurement')
+    field = request.args.get('field')
+    if not measurement or not field:
+        return "measurement and field are required", 400
+    try:
+        end = floatArg('end', time.time())
+        start = floatArg('start', end - 3600)
+        step = floatArg('step')
+        buckets = floatArg('buckets')
+    except ValueError as e:
+        return "Bad query: {}".format(e), 400
+    if start >= end:
+        return "start must be before end", 400
+    if buckets and not step:
+        step = (end - start) / buckets
+    if step is not None and step <= 0:
+        return "step must be positive", 400
+
+    samples = reading_cache.range(measurement, field, start, end, step)
+    if samples is None:
+        return "No readings for {} {}".format(measurement, field), 404
+    return jsonify({"measurement": measurement, "field": field, "start": start, "end": end,
+                    "step": step, "samples": samples}), 200
+
+@app.route("/metrics")
+def publisherMetrics():
+    body, content_type = metrics.render()
+    return body, 200, {'Content-Type': content_type}
+
 def set_log_level(log_level):
     if log_level == 'DEBUG':
         app.logger.setLevel(logging.DEBUG)
@@ -216,7 +458,9 @@ def set_log_level(log_level):
         print('Not sure what you want me to do with a log_level of {}, so I will just spit everything at you...'.format(log_level))
         app.logger.setLevel(logging.DEBUG)
 
+set_log_level(log_level)
+
 if __name__ == "__main__":
-    set_log_level(log_level)
     print('Log Level: {}'.format(log_level))
-    app.run(host='0.0.0.0', port=8080, debug=True)
+    # The reloader would start a second copy of the background threads
+    app.run(host='0.0.0.0', port=int(os.getenv('PORT', '8080')), debug=os.getenv('FLASK_DEBUG', 'false').lower() == 'true', use_reloader=False)
@@ -0,0 +1,62 @@
+# Gunicorn settings for the publisher, driven by env vars set in the Dockerfile
+#
+# Each worker process runs its own write pipeline, spool replayer, container
+# inventory, health poller and reading cache, so keep WEB_WORKERS low on a Pi
+# and scale with WEB_THREADS first.
+
+import os
+
+bind = '0.0.0.0:{}'.format(os.getenv('PORT', '8080'))
+worker_class = 'gthread'
+workers = int(os.getenv('WEB_WORKERS', '1'))
+threads = int(os.getenv('WEB_THREADS', '8'))
+timeout = int(os.getenv('WEB_TIMEOUT', '30'))
+graceful_timeout = int(os.getenv('WEB_GRACEFUL_TIMEOUT', '15'))
+keepalive = int(os.getenv('WEB_KEEPALIVE', '75'))
+backlog = int(os.getenv('WEB_BACKLOG', '2048'))
+accesslog = os.getenv('WEB_ACCESS_LOG') or None
+errorlog = '-'
+loglevel = os.getenv('LOG_LEVEL', 'INFO').lower()
+
+
+# The local reading socket (local_socket.py) is bound once here and handed to
+# every worker, which would otherwise race to bind the same path
+def when_ready(server):
+    path = os.getenv('LOCAL_SOCKET', '/mnt/shared/publisher.sock')
+    if not path:
+        return
+    from local_socket import bindSocket
+    try:
+        server.local_socket = bindSocket(path)
+    except OSError as e:
+        server.log.error('Failed to listen on {}: {}'.format(path, e))
+        os.environ['LOCAL_SOCKET'] = ''
+        return
+    server.local_socket.set_inheritable(True)
+    os.environ['LOCAL_SOCKET_FD'] = str(server.local_socket.fileno())
+
+
+def on_exit(server):
+    if getattr(server, 'local_socket', None) is not None:
+        server.local_socket.close()
+        try:
+            os.unlink(os.getenv('LOCAL_SOCKET', '/mnt/shared/publisher.sock'))
+        except OSError:
+            pass
+
+
+# With PROMETHEUS_MULTIPROC_DIR set each worker writes its metrics there and
+# /metrics adds them up (see metrics.py)
+def on_starting(server):
+    multiproc_dir = os.getenv('PROMETHEUS_MULTIPROC_DIR')
+    if multiproc_dir:
+        os.makedirs(multiproc_dir, exist_ok=True)
+        for name in os.listdir(multiproc_dir):
+            if name.endswith('.db'):
+                os.remove(os.path.join(multiproc_dir, name))
+
+
+def child_exit(server, worker):
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+
+# Container health poller
+#
+# Every running container's health endpoint is checked at the same time from a
+# thread pool, over pooled keep-alive connections, with a timeout on each
+# request, so a scan takes about one timeout however many containers there are.
+# Results are kept in a TTL cache with a short history per container.
+
+import collections
+import concurrent.futures
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+class HealthPoller(object):
+
+    def __init__(self, get_containers, port='8080', path='/health', interval=30.0, timeout=2.0, ttl=90.0, history=20, max_workers=16, logger=None):
+        self.get_containers = get_containers
+        self.port = port
+        self.path = path
+        self.interval = interval
+        self.timeout = timeout
+        self.ttl = ttl
+        self.history = history
+        self.logger = logger
+
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+        self._session.mount('http://', adapter)
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='health')
+
+        self._lock = threading.Lock()
+        self._results = {}
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='health-poller', daemon=True)
+            self._thread.start()
+
+    def poll(self):
+        names = [c['name'] for c in self.get_containers() if c['status'] == 'running']
+        for name, result in zip(names, self._executor.map(self._check, names)):
+            self._record(name, result)
+
+    def results(self):
+        now = time.time()
+        with self._lock:
+            for name in [n for n, r in self._results.items() if now - r['last_checked'] > self.ttl]:
+                del self._results[name]
+            return dict((name, self._public(r)) for name, r in self._results.items())
+
+    def _check(self, name):
+        url = 'http://{}:{}{}'.format(name, self.port, self.path)
+        result = {'ok': False, 'status_code': None, 'health_data': None, 'error': None}
+        start = time.monotonic()
+        try:
+            response = self._session.get(url, timeout=self.timeout)
+            result['status_code'] = response.status_code
+            if response.status_code == 200:
+                result['ok'] = True
+                try:
+                    result['health_data'] = response.json()
+                except ValueError:
+                    result['health_data'] = response.text
+        except Exception as e:
+            result['error'] = str(e)
+        result['latency'] = time.monotonic() - start
+        result['last_checked'] = time.time()
+        return result
+
+    def _record(self, name, result):
+        with self._lock:
+            previous = self._results.get(name)
+            history = previous['history'] if previous else collections.deque(maxlen=self.history)
+            history.append({'at': result['last_checked'], 'ok': result['ok'], 'latency': result['latency']})
+            result['history'] = history
+            if result['ok']:
+                result['last_seen'] = result['last_checked']
+            else:
+                result['last_seen'] = previous['last_seen'] if previous else None
+            self._results[name] = result
+
+    def _public(self, result):
+        public = dict(result)
+        public['history'] = list(result['history'])
+        return public
+
+    def _run(self):
+        while True:
+            try:
+                self.poll()
+            except Exception as e:
+                if self.logger:
+                    self.logger.error("Health poll failed: {}".format(e))
+            time.sleep(self.interval)
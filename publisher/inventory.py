@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+
+# Cached container inventory
+#
+# Container details are gathered off the request path, on a fixed interval and
+# whenever the Docker events stream reports a container change, and callers
+# read the last snapshot from memory.
+
+import threading
+import time
+
+import metrics
+
+# Container events that change what the inventory reports
+refresh_actions = ('create', 'start', 'restart', 'stop', 'die', 'kill', 'pause', 'unpause', 'rename', 'destroy')
+
+
+class ContainerInventory(object):
+
+    def __init__(self, docker_client, refresh_interval=60.0, use_events=True, logger=None):
+        self.docker_client = docker_client
+        self.refresh_interval = refresh_interval
+        self.use_events = use_events
+        self.logger = logger
+
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._containers = []
+        self._refreshed_at = None
+        self._refresh_duration = None
+        self._images = {}
+        self._threads = []
+
+    def start(self):
+        if self._threads or self.docker_client is None:
+            return
+        self._threads.append(threading.Thread(target=self._run, name='inventory-refresh', daemon=True))
+        if self.use_events:
+            self._threads.append(threading.Thread(target=self._watch_events, name='inventory-events', daemon=True))
+        for t in self._threads:
+            t.start()
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'refreshed_at': self._refreshed_at,
+                'refresh_duration': self._refresh_duration,
+                'containers': list(self._containers),
+            }
+
+    def containers(self):
+        with self._lock:
+            return list(self._containers)
+
+    def refresh(self):
+        start = time.monotonic()
+        with metrics.docker_api_latency.labels('containers').time():
+            containers = self.docker_client.containers.list(all=True)
+        details = [self._describe(c) for c in containers]
+
+        # Drop images that no container references any more
+        in_use = set(c.attrs['Image'] for c in containers)
+        for image_id in list(self._images):
+            if image_id not in in_use:
+                del self._images[image_id]
+
+        with self._lock:
+            self._containers = details
+            self._refreshed_at = time.time()
+            self._refresh_duration = time.monotonic() - start
+
+    def _describe(self, cont):
+        attrs = cont.attrs
+
+        processes = []
+        if cont.status == 'running':
+            try:
+                with metrics.docker_api_latency.labels('top').time():
+                    top = cont.top()
+                for p in top['Processes']:
+                    processes.append(dict(zip(top['Titles'], p)))
+            except Exception as e:
+                self._log_debug("top() failed for {}: {}".format(cont.name, e))
+
+        container = {}
+        container['id'] = cont.id
+        container['name'] = cont.name
+        container['hostname'] = attrs['Config']['Hostname']
+        container['status'] = cont.status
+        container['state'] = attrs['State']
+        container['image_tags'] = self._image_tags(attrs['Image'])
+        container['created'] = attrs['Created']
+        container['running_processes'] = processes
+        container['networks'] = attrs['NetworkSettings']
+        return container
+
+    def _image_tags(self, image_id):
+        # Image tags rarely change, so only look each image up once
+        if image_id not in self._images:
+            try:
+                with metrics.docker_api_latency.labels('image').time():
+                    self._images[image_id] = self.docker_client.images.get(image_id).attrs['RepoTags']
+            except Exception as e:
+                self._log_debug("Image lookup failed for {}: {}".format(image_id, e))
+                return []
+        return self._images[image_id]
+
+    def _run(self):
+        while True:
+            try:
+                self.refresh()
+            except Exception as e:
+                if self.logger:
+                    self.logger.error("Container inventory refresh failed: {}".format(e))
+            self._wake.wait(self.refresh_interval)
+            self._wake.clear()
+            # Let a burst of events (e.g. compose up) settle into one refresh
+            time.sleep(0.5)
+
+    def _watch_events(self):
+        while True:
+            try:
+                for event in self.docker_client.events(decode=True, filters={'type': 'container'}):
+                    if event.get('Action') in refresh_actions:
+                        self._wake.set()
+            except Exception as e:
+                if self.logger:
+                    self.logger.warning("Docker events stream failed: {}".format(e))
+            time.sleep(self.refresh_interval)
+
+    def _log_debug(self, message):
+        if self.logger:
+            self.logger.debug(message)
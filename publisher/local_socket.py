@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+
+# Local transport for readings from sensor containers on the same node
+#
+# Sensors with PUBLISH_TRANSPORT=uds send readings over a SOCK_SEQPACKET Unix
+# socket in /mnt/shared instead of POSTing them over the Docker network. Each
+# message is one reading or a list of readings, as MessagePack (or JSON,
+# told apart by the first byte), and is answered with an HTTP-style status
+# code in ASCII: b'200' once the points are queued, b'400' for a bad reading,
+# b'413' for a message larger than max_message and b'500' when the write
+# queue is full. Sensors keep one connection open, so there is no TCP, HTTP
+# parsing or per-request connection setup.
+#
+# Under gunicorn the master binds the socket (gunicorn.conf.py) and passes it
+# to the workers in LOCAL_SOCKET_FD; every worker accepts on it, so each
+# sensor connection is served by one of them. Run any other way, the process
+# binds the socket itself.
+
+import os
+import socket
+import stat
+import threading
+
+
+def bindSocket(path, backlog=16):
+    # A socket left behind by an earlier run would make bind fail
+    try:
+        if stat.S_ISSOCK(os.stat(path).st_mode):
+            os.unlink(path)
+    except FileNotFoundError:
+        pass
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    sock.bind(path)
+    os.chmod(path, 0o666)
+    sock.listen(backlog)
+    return sock
+
+
+class LocalListener(object):
+
+    def __init__(self, path, handler, max_message=512 * 1024, logger=None):
+        # handler(body) -> (response, status), e.g. an IngestTimer'd view
+        self.path = path
+        self.handler = handler
+        self.max_message = max_message
+        self.logger = logger
+
+        self._sock = None
+        self._thread = None
+        self._lock = threading.Lock()
+        self._stats = {
+            'connections': 0,
+            'open_connections': 0,
+            'messages': 0,
+            'failed': 0,
+            'truncated': 0,
+        }
+
+    def start(self):
+        if self._thread is not None:
+            return
+        fd = os.getenv('LOCAL_SOCKET_FD')
+        if fd:
+            self._sock = socket.socket(fileno=int(fd))
+        else:
+            self._sock = bindSocket(self.path)
+        self._thread = threading.Thread(target=self._accept, name='local-listener', daemon=True)
+        self._thread.start()
+        if self.logger:
+            self.logger.info('Accepting readings on {}'.format(self.path))
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+        stats['path'] = self.path
+        return stats
+
+    def _count(self, name, n=1):
+        with self._lock:
+            self._stats[name] += n
+
+    def _accept(self):
+        while True:
+            try:
+                conn, _ = self._sock.accept()
+            except OSError as e:
+                if self.logger:
+                    self.logger.error('Local socket accept failed: {}'.format(e))
+                return
+            self._count('connections')
+            threading.Thread(target=self._serve, args=(conn,), name='local-connection', daemon=True).start()
+
+    def _serve(self, conn):
+        # One reusable buffer per connection; a message that doesn't fit is
+        # truncated by the kernel and refused
+        buf = bytearray(self.max_message)
+        view = memoryview(buf)
+        self._count('open_connections')
+        try:
+            while True:
+                nbytes, _, flags, _ = conn.recvmsg_into([buf])
+                if nbytes == 0:
+                    break
+                if flags & socket.MSG_TRUNC:
+                    self._count('truncated')
+                    status = 413
+                else:
+                    try:
+                        _, status = self.handler(bytes(view[:nbytes]))
+                    except Exception as e:
+                        if self.logger:
+                            self.logger.error('Local reading failed: {}'.format(e))
+                        status = 500
+                self._count('messages')
+                if status != 200:
+                    self._count('failed')
+                conn.send(str(status).encode('ascii'))
+        except OSError:
+            pass
+        finally:
+            self._count('open_connections', -1)
+            conn.close()
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+
+# Prometheus metrics for the publisher, served on /metrics
+#
+# Label children are bound once (at import for the known sensor types and
+# endpoints, on first use otherwise) so the request path only does a dict
+# lookup and an increment or observe per metric. sensor_type comes from the
+# sensors, so after max_sensor_types distinct values the rest are counted as
+# "other".
+#
+# With several gunicorn workers, set PROMETHEUS_MULTIPROC_DIR to an empty
+# directory so every worker's metrics are aggregated on each scrape;
+# gunicorn.conf.py clears it on start and cleans up after exited workers.
+
+import os
+import threading
+import time
+
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest
+
+known_sensor_types = ('bme680', 'hm3301', 'multigas')
+max_sensor_types = 32
+
+ingest_requests = Counter('publisher_ingest_requests_total',
+                          'Reading POSTs by endpoint and HTTP status',
+                          ['endpoint', 'status'])
+ingest_latency = Histogram('publisher_ingest_request_seconds',
+                           'Time spent handling reading POSTs',
+                           ['endpoint'],
+                           buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5))
+readings_received = Counter('publisher_readings_total',
+                            'Readings accepted for writing',
+                            ['sensor_type'])
+points_prepared = Counter('publisher_points_prepared_total',
+                          'InfluxDB points prepared from readings',
+                          ['sensor_type'])
+points_dropped = Counter('publisher_points_dropped_total',
+                         'Points dropped because the write queue was full')
+queue_depth = Gauge('publisher_write_queue_depth',
+                    'Points waiting in the write queue',
+                    multiprocess_mode='livesum')
+influx_write_latency = Histogram('publisher_influx_write_seconds',
+                                 'InfluxDB batch write latency, including failed writes',
+                                 buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0))
+influx_writes = Counter('publisher_influx_writes_total',
+                        'InfluxDB batch writes by result (written, rejected, spooled or failed)',
+                        ['result'])
+influx_points = Counter('publisher_influx_points_total',
+                        'Points in InfluxDB batch writes by result (written, rejected, spooled or failed)',
+                        ['result'])
+docker_api_latency = Histogram('publisher_docker_api_seconds',
+                               'Docker API call latency by call',
+                               ['call'],
+                               buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0))
+
+_sensor_children = {}
+_sensor_lock = threading.Lock()
+_other_children = (readings_received.labels('other'), points_prepared.labels('other'))
+
+
+def sensorChildren(sensor_type):
+    # (readings_received, points_prepared) children for a sensor_type
+    children = _sensor_children.get(sensor_type)
+    if children is None:
+        with _sensor_lock:
+            if len(_sensor_children) >= max_sensor_types:
+                return _other_children
+            children = (readings_received.labels(sensor_type), points_prepared.labels(sensor_type))
+            _sensor_children[sensor_type] = children
+    return children
+
+
+for name in known_sensor_types:
+    sensorChildren(name)
+
+
+def countReadings(sensor_type, points, count=1):
+    readings_child, points_child = sensorChildren(sensor_type)
+    readings_child.inc(count)
+    points_child.inc(points)
+
+
+class IngestTimer(object):
+    # Times a view returning (body, status) and counts it by status
+
+    def __init__(self, endpoint):
+        self.endpoint = endpoint
+        self.latency = ingest_latency.labels(endpoint)
+        self.statuses = dict((status, ingest_requests.labels(endpoint, str(status)))
+                             for status in (200, 400, 413, 415, 500))
+
+    def __call__(self, view):
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                response = view(*args, **kwargs)
+                status = response[1]
+                return response
+            except Exception as e:
+                # e.g. werkzeug's 413 for a body over MAX_CONTENT_LENGTH
+                status = getattr(e, 'code', 500)
+                raise
+            finally:
+                self.latency.observe(time.perf_counter() - start)
+                self.count(status)
+        timed.__name__ = view.__name__
+        return timed
+
+    def count(self, status):
+        counter = self.statuses.get(status)
+        if counter is None:
+            counter = self.statuses[status] = ingest_requests.labels(self.endpoint, str(status))
+        counter.inc()
+
+
+def render():
+    multiproc_dir = os.getenv('PROMETHEUS_MULTIPROC_DIR')
+    if multiproc_dir:
+        from prometheus_client import multiprocess
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry, path=multiproc_dir)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
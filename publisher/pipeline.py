@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+
+# Batched write pipeline for InfluxDB
+#
+# /node/update only enqueues points here. A background flusher drains the
+# queue in batches of up to batch_size points, or whatever is waiting once the
+# oldest point is flush_interval seconds old, and writes each batch to
+# InfluxDB as a single line-protocol request (gzip'd by the client). Batches
+# that fail to write go to the spool, if there is one, for replay later. A
+# batch InfluxDB refuses for good is written again in halves until only the
+# points it refuses are left, and those are dropped (see spool.write_splitting).
+
+import collections
+import threading
+import time
+
+import metrics
+from spool import write_splitting
+
+
+class WritePipeline(object):
+
+    def __init__(self, write_api, org, bucket, queue_size=50000, batch_size=5000, flush_interval=1.0, spool=None, logger=None):
+        self.write_api = write_api
+        self.org = org
+        self.bucket = bucket
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.spool = spool
+        self.logger = logger
+
+        self._queue = collections.deque()
+        self._oldest = None
+        self._cond = threading.Condition()
+        self._stopping = False
+        self._thread = None
+
+        self._stats = {
+            'enqueued': 0,
+            'dropped': 0,
+            'written': 0,
+            'failed': 0,
+            'spooled': 0,
+            'rejected': 0,
+            'batches': 0,
+            'last_batch_size': 0,
+            'last_flush_latency': 0.0,
+            'max_flush_latency': 0.0,
+        }
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='influx-writer', daemon=True)
+            self._thread.start()
+
+    def enqueue(self, points):
+        # All or nothing, so a reading is never half written
+        with self._cond:
+            if len(self._queue) + len(points) > self.queue_size:
+                self._stats['dropped'] += len(points)
+                metrics.points_dropped.inc(len(points))
+                return False
+            was_empty = not self._queue
+            if was_empty:
+                self._oldest = time.monotonic()
+            self._queue.extend(points)
+            self._stats['enqueued'] += len(points)
+            metrics.queue_depth.set(len(self._queue))
+            if was_empty or len(self._queue) >= self.batch_size:
+                self._cond.notify()
+        return True
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._stats)
+            stats['queue_depth'] = len(self._queue)
+        stats['queue_size'] = self.queue_size
+        stats['batch_size'] = self.batch_size
+        stats['flush_interval'] = self.flush_interval
+        return stats
+
+    def write_lines(self, lines):
+        self.write_api.write(bucket=self.bucket, org=self.org, record=lines)
+
+    def close(self, timeout=10.0):
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _next_batch(self):
+        with self._cond:
+            while not self._stopping:
+                if len(self._queue) >= self.batch_size:
+                    break
+                if self._queue:
+                    remaining = self._oldest + self.flush_interval - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                else:
+                    self._cond.wait()
+
+            count = min(len(self._queue), self.batch_size)
+            batch = [self._queue.popleft() for _ in range(count)]
+            if not self._queue:
+                self._oldest = None
+            metrics.queue_depth.set(len(self._queue))
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch:
+                self._flush(batch)
+            with self._cond:
+                if self._stopping and not self._queue:
+                    return
+
+    def _flush(self, batch):
+        lines = [point.to_line_protocol() for point in batch]
+        start = time.monotonic()
+        rejected = 0
+        try:
+            rejected = write_splitting(self.write_lines, lines, self.logger)
+            ok = True
+        except Exception as e:
+            if self.logger:
+                self.logger.error("Error writing batch of {} points: {}".format(len(lines), e))
+            ok = False
+        latency = time.monotonic() - start
+        metrics.influx_write_latency.observe(latency)
+
+        spooled = False
+        if not ok and self.spool is not None:
+            try:
+                self.spool.append(lines)
+                spooled = True
+            except Exception as e:
+                if self.logger:
+                    self.logger.error("Error spooling batch of {} points: {}".format(len(lines), e))
+
+        with self._cond:
+            self._stats['batches'] += 1
+            self._stats['last_batch_size'] = len(lines)
+            self._stats['last_flush_latency'] = latency
+            self._stats['max_flush_latency'] = max(self._stats['max_flush_latency'], latency)
+            if ok:
+                counts = {'written': len(lines) - rejected, 'rejected': rejected}
+                result = 'written' if rejected < len(lines) else 'rejected'
+            else:
+                result = 'spooled' if spooled else 'failed'
+                counts = {result: len(lines)}
+            for name, count in counts.items():
+                self._stats[name] += count
+        metrics.influx_writes.labels(result).inc()
+        for name, count in counts.items():
+            if count:
+                metrics.influx_points.labels(name).inc(count)
+
+        if ok and self.logger:
+            self.logger.debug("Wrote batch of {} points in {:.3f}s".format(len(lines), latency))
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+
+# Reading format shared by the sensor containers and the publisher
+#
+# A reading is a flat object:
+#   schema_version  int, currently 1 (readings without it are pre-v1)
+#   sensor_type     str
+#   timestamp       epoch seconds of the sample, finite and within InfluxDB's range
+#   local_time      "%d-%m-%Y %H:%M:%S" sample time on the sensor node
+# plus one int (int64), float, bool or str per measurement.
+#
+# Readings are sent as JSON (application/json) or MessagePack
+# (application/msgpack); batches may also be newline-delimited JSON
+# (application/x-ndjson).
+
+import ast
+import json
+import math
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+schema_version = 1
+
+json_types = ('application/json',)
+msgpack_types = ('application/msgpack', 'application/x-msgpack')
+ndjson_types = ('application/x-ndjson', 'application/ndjson')
+
+meta_keys = ('schema_version', 'sensor_type', 'local_time', 'timestamp')
+# InfluxDB stores nanoseconds since the epoch in an int64 (1677 to 2262)
+max_timestamp = 2 ** 63 / 1e9
+# and int fields in an int64 too
+min_int, max_int = -2 ** 63, 2 ** 63 - 1
+field_types = (int, float, bool, str)
+
+
+def loads(body):
+    if orjson is not None:
+        return orjson.loads(body)
+    return json.loads(body)
+
+
+def decode(mimetype, body):
+    # None means the content type isn't one we read
+    if mimetype in json_types:
+        return loads(body)
+    if mimetype in msgpack_types and msgpack is not None:
+        return msgpack.unpackb(body, raw=False)
+    return None
+
+
+def decodeBatch(mimetype, body):
+    if mimetype in ndjson_types:
+        payloads = [loads(line) for line in body.splitlines() if line.strip()]
+    else:
+        payloads = decode(mimetype, body)
+        if payloads is None:
+            return None
+        if type(payloads) is not list:
+            payloads = [payloads]
+    return [validateReading(p) for p in payloads]
+
+
+def validateReading(payload):
+    if type(payload) is str:
+        # Sensors older than schema v1 posted the Python repr of their dict
+        try:
+            payload = ast.literal_eval(payload)
+        except (ValueError, SyntaxError):
+            raise ValueError('reading is not an object')
+    if type(payload) is not dict:
+        raise ValueError('reading is not an object')
+
+    version = payload.get('schema_version', 0)
+    if type(version) is not int or version > schema_version:
+        raise ValueError('unsupported schema_version {}'.format(version))
+    if type(payload.get('sensor_type')) is not str:
+        raise ValueError('reading needs a sensor_type')
+    if 'timestamp' in payload:
+        timestamp = payload['timestamp']
+        if type(timestamp) not in (int, float):
+            raise ValueError('timestamp must be epoch seconds')
+        if not math.isfinite(timestamp) or abs(timestamp) >= max_timestamp:
+            raise ValueError('timestamp {} is out of range'.format(timestamp))
+
+    for key, value in payload.items():
+        if type(key) is not str:
+            raise ValueError('field names must be strings')
+        if key not in meta_keys and type(value) not in field_types:
+            raise ValueError('field {} has unsupported type {}'.format(key, type(value).__name__))
+        if type(value) is int and not min_int <= value <= max_int:
+            raise ValueError('field {} is out of range'.format(key))
+    return payload
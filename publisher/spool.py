@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+
+# Store-and-forward spool for InfluxDB writes
+#
+# Batches that fail to write are appended, as line protocol, to segment files
+# in the spool directory. Segments are append-only and sealed once they reach
+# segment_size; the oldest sealed segments are dropped when the spool grows
+# past max_bytes. A SpoolReplayer drains sealed segments, oldest first, in
+# large batches and backs off exponentially while InfluxDB is unreachable.
+#
+# Segment names carry the creation time and owning pid:
+#   segment-<time_ns>-<pid>.open          being appended to
+#   segment-<time_ns>-<pid>.seg           sealed, waiting for replay
+#   segment-<time_ns>-<pid>.seg.<pid>     claimed by a replayer
+# so several publisher processes can share one spool directory.
+#
+# Only writes that may succeed later are spooled: connection errors, 5xx and
+# 429. Anything else InfluxDB refuses (400 for bad line protocol, 422 for
+# points outside the retention policy) would be refused again on replay. A
+# refused batch is written again in halves, narrowing down to the points
+# InfluxDB refuses, which are dropped and counted as rejected.
+
+import os
+import threading
+import time
+
+
+def retryable(e):
+    # influxdb_client's ApiException carries the HTTP status; connection
+    # errors don't have one
+    status = getattr(e, 'status', None)
+    if not status:
+        return True
+    return status >= 500 or status == 429
+
+
+def write_splitting(write_lines, lines, logger=None):
+    # Returns how many lines InfluxDB refused for good; raises retryable
+    # errors. Halves written before one are written again when the batch is
+    # retried, which is harmless: InfluxDB overwrites points with the same
+    # series and timestamp.
+    try:
+        write_lines(lines)
+        return 0
+    except Exception as e:
+        if retryable(e):
+            raise
+        if len(lines) == 1:
+            if logger:
+                logger.error("InfluxDB rejected point, dropping it: {}: {}".format(lines[0], e))
+            return 1
+    half = len(lines) // 2
+    return write_splitting(write_lines, lines[:half], logger) + write_splitting(write_lines, lines[half:], logger)
+
+
+class Spool(object):
+
+    def __init__(self, directory, segment_size=4 * 1024 * 1024, max_bytes=256 * 1024 * 1024, logger=None):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_bytes = max_bytes
+        self.logger = logger
+
+        self._lock = threading.Lock()
+        self._active = None
+        self._active_size = 0
+        self._stats = {
+            'spooled': 0,
+            'dropped': 0,
+        }
+
+        os.makedirs(self.directory, exist_ok=True)
+        self._recover()
+
+    def append(self, lines):
+        if not lines:
+            return
+        data = ('\n'.join(lines) + '\n').encode('utf-8')
+        with self._lock:
+            if self._active is None:
+                name = 'segment-{:020d}-{}.open'.format(time.time_ns(), os.getpid())
+                self._active = os.path.join(self.directory, name)
+                self._active_size = 0
+            with open(self._active, 'ab') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            self._active_size += len(data)
+            self._stats['spooled'] += len(lines)
+            if self._active_size >= self.segment_size:
+                self._seal()
+        self._enforce_cap()
+
+    def seal(self):
+        with self._lock:
+            self._seal()
+
+    def claim(self):
+        # Oldest sealed segment, renamed so no other replayer picks it up
+        for name in self._segments('.seg'):
+            path = os.path.join(self.directory, name)
+            claimed = '{}.{}'.format(path, os.getpid())
+            try:
+                os.rename(path, claimed)
+                return claimed
+            except FileNotFoundError:
+                continue
+        return None
+
+    def read(self, claimed):
+        with open(claimed, 'rb') as f:
+            return [line for line in f.read().decode('utf-8').split('\n') if line]
+
+    def ack(self, claimed):
+        os.remove(claimed)
+
+    def release(self, claimed):
+        os.rename(claimed, claimed.rsplit('.', 1)[0])
+
+    def pending(self):
+        with self._lock:
+            return self._active is not None
+
+    def stats(self):
+        segments = 0
+        size = 0
+        for entry in os.scandir(self.directory):
+            if entry.name.startswith('segment-'):
+                segments += 1
+                size += entry.stat().st_size
+        with self._lock:
+            stats = dict(self._stats)
+        stats['segments'] = segments
+        stats['bytes'] = size
+        return stats
+
+    def _seal(self):
+        if self._active is not None:
+            os.rename(self._active, self._active[:-len('.open')] + '.seg')
+            self._active = None
+            self._active_size = 0
+
+    def _segments(self, suffix):
+        return sorted(n for n in os.listdir(self.directory) if n.startswith('segment-') and n.endswith(suffix))
+
+    def _enforce_cap(self):
+        sealed = []
+        total = 0
+        for entry in os.scandir(self.directory):
+            if entry.name.startswith('segment-'):
+                size = entry.stat().st_size
+                total += size
+                if entry.name.endswith('.seg'):
+                    sealed.append((entry.name, size))
+
+        for name, size in sorted(sealed):
+            if total <= self.max_bytes:
+                break
+            path = os.path.join(self.directory, name)
+            try:
+                with open(path, 'rb') as f:
+                    dropped = f.read().count(b'\n')
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+            total -= size
+            with self._lock:
+                self._stats['dropped'] += dropped
+            if self.logger:
+                self.logger.warning("Spool over {} bytes, dropped {} oldest lines".format(self.max_bytes, dropped))
+
+    def _recover(self):
+        # Seal open segments and un-claim segments left by processes that are
+        # gone. Our own pid can only appear here from a previous container run.
+        for name in os.listdir(self.directory):
+            if not name.startswith('segment-'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                if name.endswith('.open'):
+                    pid = int(name[:-len('.open')].rsplit('-', 1)[1])
+                    if not self._alive(pid):
+                        os.rename(path, path[:-len('.open')] + '.seg')
+                elif not name.endswith('.seg'):
+                    base, pid = path.rsplit('.', 1)
+                    if not self._alive(int(pid)):
+                        os.rename(path, base)
+            except (ValueError, IndexError):
+                continue
+            except FileNotFoundError:
+                continue
+
+    def _alive(self, pid):
+        if pid == os.getpid():
+            return False
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+
+
+class SpoolReplayer(object):
+
+    def __init__(self, spool, write_lines, batch_size=10000, interval=5.0, max_backoff=300.0, logger=None):
+        self.spool = spool
+        self.write_lines = write_lines
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_backoff = max_backoff
+        self.logger = logger
+
+        self._backoff = 0.0
+        self._thread = None
+        self._stats = {
+            'replayed': 0,
+            'replay_failures': 0,
+            'rejected': 0,
+        }
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='spool-replay', daemon=True)
+            self._thread.start()
+
+    def stats(self):
+        stats = dict(self._stats)
+        stats['backoff'] = self._backoff
+        return stats
+
+    def replay_once(self):
+        claimed = self.spool.claim()
+        if claimed is None:
+            # Nothing sealed yet; seal what this process has spooled so far
+            if not self.spool.pending():
+                return False
+            self.spool.seal()
+            claimed = self.spool.claim()
+            if claimed is None:
+                return False
+
+        lines = self.spool.read(claimed)
+        rejected = 0
+        try:
+            for i in range(0, len(lines), self.batch_size):
+                # Points refused for good are dropped; retrying them would
+                # hold up every later segment
+                rejected += write_splitting(self.write_lines, lines[i:i + self.batch_size], self.logger)
+        except Exception:
+            # Replaying the whole segment again is safe: InfluxDB overwrites
+            # points with the same series and timestamp
+            self.spool.release(claimed)
+            raise
+        self.spool.ack(claimed)
+        self._stats['replayed'] += len(lines) - rejected
+        self._stats['rejected'] += rejected
+        if self.logger:
+            self.logger.info("Replayed {} spooled points".format(len(lines) - rejected))
+        return True
+
+    def _run(self):
+        while True:
+            try:
+                replayed = self.replay_once()
+                self._backoff = 0.0
+            except Exception as e:
+                self._stats['replay_failures'] += 1
+                self._backoff = min(self.max_backoff, max(self.interval, self._backoff * 2))
+                if self.logger:
+                    self.logger.warning("Spool replay failed, retrying in {:.0f}s: {}".format(self._backoff, e))
+                time.sleep(self._backoff)
+                continue
+            if not replayed:
+                time.sleep(self.interval)
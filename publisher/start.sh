@@ -0,0 +1,9 @@
+#!/bin/bash
+
+# SERVER=gunicorn (default) runs the production server,
+# SERVER=flask runs the Flask development server
+if [ "${SERVER:-gunicorn}" = "flask" ]; then
+    exec python app.py
+else
+    exec gunicorn -c gunicorn.conf.py app:app
+fi
@@ -0,0 +1,318 @@
+#!/usr/bin/env python
+
+# Local cache of recent readings, served on /readings/latest and /readings/range
+#
+# Every numeric field of a reading, other than its metadata, is appended to a
+# ring buffer for its (measurement, field), where the measurement is the
+# reading's sensor_type.
+# A series holds its last capacity samples as two arrays of doubles, sample
+# times and values, so appends are O(1) and a range query is a binary search
+# over the times followed by one pass over the matching samples. range()
+# returns the raw samples or, given a step, the min, max, mean and count of
+# each step-wide bucket.
+#
+# With a directory, each series lives in a memory-mapped file there instead
+#   <measurement>.<field>.series   header, then capacity times, then capacity values
+# so recent readings survive a restart and stay out of the Python heap. Only
+# one process can own the directory (the one holding its lock file); any
+# other keeps its series in memory.
+#
+# Samples that aren't finite are skipped, and so are samples more than
+# future_slack seconds ahead of the clock (a sensor with a bad clock would
+# otherwise hold back every later sample) and samples no newer than the
+# newest one in their series (e.g. a reading the sensor sent again), so each
+# series stays sorted by time. A series loaded from disk whose newest sample
+# is ahead of the clock is cleared instead, since its samples were taken
+# before the clock was set back (e.g. by NTP after booting a Pi without an
+# RTC).
+
+import array
+import fcntl
+import math
+import mmap
+import os
+import re
+import struct
+import threading
+import time
+
+import readings
+
+magic = b'KTS1'
+# magic, capacity, head (next slot), count
+header = struct.Struct('<4s4xQQQ')
+series_name = re.compile(r'^[A-Za-z0-9_-]+$')
+meta_keys = frozenset(readings.meta_keys)
+numeric_types = (int, float, bool)
+
+
+class Series(object):
+
+    def __init__(self, capacity, path=None):
+        self.capacity = capacity
+        self.path = path
+        self.head = 0
+        self.count = 0
+        # Time of the newest sample, or None
+        self.last = None
+        # Whether the samples held came from an earlier run's file
+        self.loaded = False
+        self._mmap = None
+
+        if path is not None:
+            self._open(path)
+        else:
+            self.times = memoryview(array.array('d', bytes(8 * capacity)))
+            self.values = memoryview(array.array('d', bytes(8 * capacity)))
+
+    def _open(self, path):
+        size = header.size + 16 * self.capacity
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fresh = os.fstat(fd).st_size != size
+            if fresh:
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, size)
+            self._mmap = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        if not fresh:
+            file_magic, capacity, head, count = header.unpack_from(self._mmap)
+            fresh = file_magic != magic or capacity != self.capacity or head >= capacity or count > capacity
+            if not fresh:
+                self.head, self.count = head, count
+        if fresh:
+            self._write_header()
+        data = memoryview(self._mmap)[header.size:].cast('d')
+        self.times = data[:self.capacity]
+        self.values = data[self.capacity:]
+        if self.count:
+            self.last = self.times[(self.head - 1) % self.capacity]
+            self.loaded = True
+
+    def _write_header(self):
+        header.pack_into(self._mmap, 0, magic, self.capacity, self.head, self.count)
+
+    def append(self, t, value):
+        self.times[self.head] = t
+        self.values[self.head] = value
+        self.last = t
+        self.head = (self.head + 1) % self.capacity
+        if self.count < self.capacity:
+            self.count += 1
+        if self._mmap is not None:
+            self._write_header()
+
+    def clear(self):
+        self.head = 0
+        self.count = 0
+        self.last = None
+        self.loaded = False
+        if self._mmap is not None:
+            self._write_header()
+
+    def latest(self):
+        slot = (self.head - 1) % self.capacity
+        return self.times[slot], self.values[slot]
+
+    def _slot(self, i):
+        # Physical slot of the i-th oldest sample
+        return (self.head - self.count + i) % self.capacity
+
+    def _bisect(self, t):
+        # Index of the first sample at or after t
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.times[self._slot(mid)] < t:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def between(self, start, end):
+        # (times, values) lists for start <= t < end, oldest first
+        first = self._bisect(start)
+        last = self._bisect(end)
+        if first >= last:
+            return [], []
+        a = self._slot(first)
+        b = self._slot(last - 1) + 1
+        if a < b:
+            return self.times[a:b].tolist(), self.values[a:b].tolist()
+        return (self.times[a:].tolist() + self.times[:b].tolist(),
+                self.values[a:].tolist() + self.values[:b].tolist())
+
+    def close(self):
+        if self._mmap is not None:
+            self.times.release()
+            self.values.release()
+            self._mmap.close()
+            self._mmap = None
+
+
+def downsample(times, values, start, step):
+    # min, max, mean and count per step-wide bucket, from start
+    buckets = []
+    current = None
+    for t, v in zip(times, values):
+        index = int((t - start) // step)
+        if current is None or index != current[0]:
+            current = [index, v, v, 0.0, 0]
+            buckets.append(current)
+        if v < current[1]:
+            current[1] = v
+        if v > current[2]:
+            current[2] = v
+        current[3] += v
+        current[4] += 1
+    return [{'time': start + index * step, 'min': low, 'max': high, 'mean': total / count, 'count': count}
+            for index, low, high, total, count in buckets]
+
+
+class ReadingCache(object):
+
+    def __init__(self, capacity=8640, directory=None, max_series=512, future_slack=300.0, logger=None):
+        self.capacity = capacity
+        self.max_series = max_series
+        self.future_slack = future_slack
+        self.logger = logger
+        self.directory = None
+
+        self._lock = threading.Lock()
+        # measurement -> field -> Series
+        self._series = {}
+        self._series_count = 0
+        self._lock_file = None
+        self._stats = {
+            'readings': 0,
+            'samples': 0,
+            'out_of_order': 0,
+            'not_finite': 0,
+            'in_future': 0,
+            'series_cleared': 0,
+            'series_dropped': 0,
+        }
+
+        if directory:
+            self._open_directory(directory)
+
+    def _open_directory(self, directory):
+        try:
+            os.makedirs(directory, exist_ok=True)
+            lock_file = open(os.path.join(directory, 'lock'), 'a')
+        except OSError as e:
+            if self.logger:
+                self.logger.error('Reading cache can not use {}: {}'.format(directory, e))
+            return
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            if self.logger:
+                self.logger.info('Reading cache in {} is owned by another process, keeping this one in memory'.format(directory))
+            return
+        self._lock_file = lock_file
+        self.directory = directory
+        for name in sorted(os.listdir(directory)):
+            parts = name.split('.')
+            if len(parts) == 3 and parts[2] == 'series':
+                self._create(parts[0], parts[1])
+
+    def _create(self, measurement, field):
+        # Called with self._lock held, or from __init__
+        path = None
+        if self.directory is not None and series_name.match(measurement) and series_name.match(field):
+            path = os.path.join(self.directory, '{}.{}.series'.format(measurement, field))
+        try:
+            series = Series(self.capacity, path)
+        except (OSError, ValueError) as e:
+            if self.logger:
+                self.logger.error('Reading cache file {} failed, keeping it in memory: {}'.format(path, e))
+            series = Series(self.capacity)
+        self._series.setdefault(measurement, {})[field] = series
+        self._series_count += 1
+        return series
+
+    def add(self, measurement, t, fields):
+        # fields is the reading; metadata and non-numeric fields are left out
+        now = time.time()
+        with self._lock:
+            self._stats['readings'] += 1
+            if not math.isfinite(t):
+                self._stats['not_finite'] += 1
+                return
+            if t > now + self.future_slack:
+                self._stats['in_future'] += 1
+                return
+            measurement_series = self._series.get(measurement, {})
+            for field, value in fields.items():
+                if field in meta_keys or type(value) not in numeric_types:
+                    continue
+                try:
+                    value = float(value)
+                except OverflowError:
+                    value = math.inf
+                if not math.isfinite(value):
+                    self._stats['not_finite'] += 1
+                    continue
+                series = measurement_series.get(field)
+                if series is None:
+                    if self._series_count >= self.max_series:
+                        self._stats['series_dropped'] += 1
+                        continue
+                    series = self._create(measurement, field)
+                    measurement_series = self._series[measurement]
+                last = series.last
+                if last is not None and t <= last:
+                    if not series.loaded or last <= now + self.future_slack:
+                        self._stats['out_of_order'] += 1
+                        continue
+                    series.clear()
+                    self._stats['series_cleared'] += 1
+                series.append(t, value)
+                self._stats['samples'] += 1
+
+    def latest(self, measurement=None, field=None):
+        # {measurement: {field: {"time": t, "value": v}}}
+        result = {}
+        with self._lock:
+            for m, fields in self._series.items():
+                if measurement is not None and m != measurement:
+                    continue
+                for f, series in fields.items():
+                    if (field is None or f == field) and series.count:
+                        t, v = series.latest()
+                        result.setdefault(m, {})[f] = {'time': t, 'value': v}
+        return result
+
+    def range(self, measurement, field, start, end, step=None):
+        # None if there is no such series
+        with self._lock:
+            series = self._series.get(measurement, {}).get(field)
+            if series is None:
+                return None
+            times, values = series.between(start, end)
+        if step:
+            return downsample(times, values, start, step)
+        return [{'time': t, 'value': v} for t, v in zip(times, values)]
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['series'] = self._series_count
+            stats['samples_held'] = sum(s.count for fields in self._series.values() for s in fields.values())
+        stats['capacity'] = self.capacity
+        stats['directory'] = self.directory
+        return stats
+
+    def close(self):
+        with self._lock:
+            for fields in self._series.values():
+                for series in fields.values():
+                    series.close()
+            self._series = {}
+            self._series_count = 0
+            if self._lock_file is not None:
+                self._lock_file.close()
+                self._lock_file = None
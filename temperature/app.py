@@ -3,44 +3,117 @@
 import bme680
 import time
 import json
-import requests
+import os
+import smbus2
+from i2c_arbiter import BusArbiter
+from publisher_client import PublisherClient
+from baseline import GasBaseline
+from scheduler import Scheduler
+from health_server import SensorHealth, serve
+import sim_bme680
 
 sensor_type = 'bme680'
 software_version = '0.0.1'
+schema_version = 1
 filename = '/mnt/shared/{}.json'.format(sensor_type)
 applog = '/mnt/shared/{}.log'.format(sensor_type)
-publish_path = 'http://publisher:8080/node/update'
+publish_path = os.getenv('PUBLISH_PATH', 'http://publisher:8080/node/update')
+publish_buffer_size = int(os.getenv('PUBLISH_BUFFER_SIZE', '8640'))
+publish_timeout = float(os.getenv('PUBLISH_TIMEOUT', '5'))
+payload_format = os.getenv('PAYLOAD_FORMAT', 'json')
+# PUBLISH_TRANSPORT=uds sends readings over the publisher's Unix socket in
+# /mnt/shared, falling back to PUBLISH_PATH while it can't be reached
+publish_transport = os.getenv('PUBLISH_TRANSPORT', 'http')
+publish_socket = os.getenv('PUBLISH_SOCKET', '/mnt/shared/publisher.sock')
+# SENSOR_BACKEND=sim reads sim_bme680 instead of the sensor, replaying
+# SIM_TRACE if set, with every sampling interval divided by SIM_SPEED.
+# TRACE_RECORD appends the real sensor's readings to a trace for it.
+sensor_backend = os.getenv('SENSOR_BACKEND', 'hw')
+sim_trace = os.getenv('SIM_TRACE')
+sim_seed = os.getenv('SIM_SEED')
+sim_speed = float(os.getenv('SIM_SPEED', '1')) if sensor_backend == 'sim' else 1.0
+trace_record = os.getenv('TRACE_RECORD')
+baseline_file = '/mnt/shared/{}_baseline.json'.format(sensor_type)
+baseline_adapt_alpha = float(os.getenv('BASELINE_ADAPT_ALPHA', '0.001'))
+baseline_max_age = float(os.getenv('BASELINE_MAX_AGE', '86400'))
+burn_in_time = float(os.getenv('BURN_IN_TIME', '30')) / sim_speed # Set to 30 for testing, 300 for prod
+burn_in_interval = float(os.getenv('BURN_IN_INTERVAL', '1')) / sim_speed
+thp_interval = float(os.getenv('THP_INTERVAL', '10')) / sim_speed
+gas_interval = float(os.getenv('GAS_INTERVAL', '10')) / sim_speed
+node_specs_interval = 60
+# Gas heater profiles as temperature(C):duration(ms), up to 10. The first is
+# the one used for the air quality score; with more than one, every gas sample
+# also cycles through the rest and publishes gas_resistance_<temp>c for each.
+heater_profiles_spec = os.getenv('HEATER_PROFILES', '320:150')
+# Bus access is serialized with the other sensor containers through a lock
+# file in I2C_LOCK_DIR
+i2c_bus = int(os.getenv('I2C_BUS', '1'))
+i2c_lock_dir = os.getenv('I2C_LOCK_DIR', '/mnt/shared/i2c' if sensor_backend != 'sim' else '/tmp/koti-i2c')
+# /health and /metrics are served on HEALTH_PORT, 0 turns them off
+health_port = int(os.getenv('HEALTH_PORT', '8080'))
 
-# Global Vars - DO NOT TOUCH #
-last_update = ''
+hum_baseline = 40.0
+hum_weighting = 0.25
 
-##############################
+def node_specs(health):
+    last_sensor_update = localTime(health.last_sample_at) if health.last_sample_at else ''
+    last_data_update = localTime(health.last_publish_at) if health.last_publish_at else ''
+    return {"sensor_type": sensor_type, "software_version": software_version, "last_sensor_update": last_sensor_update, "last_data_update": last_data_update}
 
-def node_specs():
-    return {"sensor_type": sensor_type, "software_version": software_version, "last_sensor_update": last_update, "last_data_update": last_update}
-
-def localTime():
-    seconds = time.time()
+def localTime(seconds=None):
+    if seconds is None:
+        seconds = time.time()
     result = time.localtime(seconds)
     local_time = time.strftime("%d-%m-%Y %H:%M:%S", result)
     return local_time
 
+# Readings are buffered while the publisher is unavailable
+publisher = PublisherClient(publish_path,
+                            buffer_size=publish_buffer_size,
+                            timeout=(min(2.0, publish_timeout), publish_timeout),
+                            payload_format=payload_format,
+                            transport=publish_transport,
+                            socket_path=publish_socket)
+
 def publish(update):
     try:
-        r = requests.post(publish_path, json=update)
-        if r.status_code == 200:
-            print('published {}'.format(update))
-        else:
-            print('Failed to publish: {}'.format(str(r.status_code)))
+        publisher.publish(update)
     except Exception as e:
         print(e)
         pass
 
-def getSensorData(last_update):
-    try:
-        sensor = bme680.BME680(bme680.I2C_ADDR_PRIMARY)
-    except (RuntimeError, IOError):
-        sensor = bme680.BME680(bme680.I2C_ADDR_SECONDARY)
+def parseHeaterProfiles(spec):
+    profiles = []
+    for entry in spec.split(','):
+        temp, duration = entry.strip().split(':')
+        temp, duration = int(temp), int(duration)
+        # The limits of the bme680 library's heater settings
+        if not 200 <= temp <= 400:
+            raise ValueError('HEATER_PROFILES temperature {} is not between 200 and 400 C'.format(temp))
+        if not 1 <= duration <= 4032:
+            raise ValueError('HEATER_PROFILES duration {} is not between 1 and 4032 ms'.format(duration))
+        profiles.append((temp, duration))
+    if not 1 <= len(profiles) <= 10:
+        raise ValueError('HEATER_PROFILES needs between 1 and 10 profiles')
+    if len(set(temp for temp, _ in profiles)) != len(profiles):
+        raise ValueError('HEATER_PROFILES temperatures must be unique')
+    return profiles
+
+heater_profiles = parseHeaterProfiles(heater_profiles_spec)
+heater_profile_attempts = 3
+
+def setupSensor(arbiter):
+    if sensor_backend == 'sim':
+        sensor = sim_bme680.SimBME680(trace=sim_trace, seed=sim_seed)
+    else:
+        # Every register access made by the bme680 library is one bus transaction
+        i2c_device = arbiter.wrap(smbus2.SMBus(i2c_bus), sensor_type)
+        try:
+            sensor = bme680.BME680(bme680.I2C_ADDR_PRIMARY, i2c_device=i2c_device)
+        except (RuntimeError, IOError):
+            sensor = bme680.BME680(bme680.I2C_ADDR_SECONDARY, i2c_device=i2c_device)
+        if trace_record:
+            sensor = sim_bme680.RecordingBME680(sensor, trace_record)
     
     sensor.set_humidity_oversample(bme680.OS_2X)
     sensor.set_pressure_oversample(bme680.OS_4X)
@@ -48,128 +121,185 @@ def getSensorData(last_update):
     sensor.set_filter(bme680.FILTER_SIZE_3)
     sensor.set_gas_status(bme680.ENABLE_GAS_MEAS)
 
-    sensor.set_gas_heater_temperature(320)
-    sensor.set_gas_heater_duration(150)
-    sensor.select_gas_heater_profile(0)
-
     # Up to 10 heater profiles can be configured, each
     # with their own temperature and duration.
-    # sensor.set_gas_heater_profile(200, 150, nb_profile=1)print(f"Time remaining for sensor burn-in:  {remain_time}", end='\r')
-    # sensor.select_gas_heater_profile(1)
+    for nb_profile, (temp, duration) in enumerate(heater_profiles):
+        sensor.set_gas_heater_profile(temp, duration, nb_profile=nb_profile)
+    sensor.select_gas_heater_profile(0)
 
-    start_time = time.time()
-    curr_time = time.time()
-    burn_in_time = 30 # Set to 30 for testing, 300 for prod
+    return sensor
 
-    burn_in_data = []
+def readSensor(sensor, gas):
+    # The heater only runs for samples that measure gas
+    if gas:
+        sensor.set_gas_status(bme680.ENABLE_GAS_MEAS)
+    else:
+        sensor.set_gas_status(bme680.DISABLE_GAS_MEAS)
+    return sensor.get_sensor_data()
+
+def readHeaterProfiles(sensor, output):
+    # One burst through the other heater profiles, then back to profile 0.
+    # get_sensor_data() polls for about 100 ms, so with a longer heater
+    # duration it returns False or the previous profile's measurement; each
+    # profile is read again after waiting out its duration, and a measurement
+    # only counts if its gas_index says it used that profile.
+    output["gas_resistance_{}c".format(heater_profiles[0][0])] = float(sensor.data.gas_resistance)
+    for nb_profile in range(1, len(heater_profiles)):
+        temp, duration = heater_profiles[nb_profile]
+        sensor.select_gas_heater_profile(nb_profile)
+        for attempt in range(heater_profile_attempts):
+            if sensor.get_sensor_data() and sensor.data.gas_index == nb_profile:
+                if sensor.data.heat_stable:
+                    output["gas_resistance_{}c".format(temp)] = float(sensor.data.gas_resistance)
+                break
+            time.sleep(duration / 1000.0)
+    sensor.select_gas_heater_profile(0)
+
+def thpReading(sensor):
+    output = {}
+    sample_time = time.time()
+    output["schema_version"] = schema_version
+    output["sensor_type"] = sensor_type
+    output["timestamp"] = sample_time
+    output["local_time"] = localTime(sample_time)
+    temp_c = '{:.2f}'.format(sensor.data.temperature)
+    temp_f = '{:.2f}'.format(sensor.data.temperature * 1.8 + 32)
+    press = '{:.2f}'.format(sensor.data.pressure)
+    humid = '{:.2f}'.format(sensor.data.humidity)
+    output["temperature_c"] = float(temp_c)
+    output["temperature_f"] = float(temp_f)
+    output["pressure"] = float(press)
+    output["humidity"] = float(humid)
+    return output
+
+def airQuality(gas, gas_baseline, hum):
+    gas_offset = gas_baseline - gas
+
+    hum_offset = hum - hum_baseline
+
+    if hum_offset > 0:
+        hum_score = (100 - hum_baseline - hum_offset)
+        hum_score /= (100 - hum_baseline)
+        hum_score *= (hum_weighting * 100)
     
+    else:
+        hum_score = (hum_baseline + hum_offset)
+        hum_score /= hum_baseline
+        hum_score *= (hum_weighting * 100)
+    
+    if gas_offset > 0:
+        gas_score = (gas / gas_baseline)
+        gas_score *= (100 - (hum_weighting * 100))
+
+    else:
+        gas_score = 100 - (hum_weighting * 100)
+
+    # Calculate air_quality_score.
+    air_quality_score = hum_score + gas_score
+
+    output = {}
+    output["gas_resistance"] = float(gas)
+    output["air_quality_score"] = air_quality_score
+    output["gas_score"] = gas_score
+    output["gas_baseline"] = gas_baseline
+    output["gas_offset"] = gas_offset
+    output["hum_score"] = hum_score
+    output["hum_baseline"] = hum_baseline
+    output["hum_offset"] = hum_offset
+    return output
+
+def printReading(output):
+    print(f"Sensor Type: {output['sensor_type']}", end='\n')
+    print(f"Reading Time: {output['local_time']}", end='\n')
+    print(f"Temperature: {output['temperature_c']} C / {output['temperature_f']} F", end='\n')
+    print(f"Air Pressure: {output['pressure']} hPA", end='\n')
+    print(f"Humidity: {output['humidity']} %RH", end='\n')
+    if 'air_quality_score' in output:
+        print(f"Air Quality Score: {output['air_quality_score']:.2f}", end='\n')
+    print(f"\n")
+
+def writeNodeSpecs(scheduler, health):
+    specs = node_specs(health)
+    specs["timing"] = scheduler.stats()
+    specs["i2c"] = health.arbiter.stats()
     try:
-        print('Collecting gas resistance burn-in data for {} mins\n'.format(burn_in_time / 60))
-        while curr_time - start_time < burn_in_time:
-            curr_time = time.time()
-            time_running = curr_time - start_time
-            remain_time = burn_in_time - time_running
-            remain_time = int(remain_time)
-            if remain_time <= 9:
-                print(f"Time remaining for sensor burn-in:  {remain_time}s", end='\r')
-            else:
-                print(f"Time remaining for sensor burn-in: {remain_time}s", end='\r')
+        with open(filename, 'w') as f:
+            json.dump(specs, f)
+    except OSError as e:
+        print('Could not write {}: {}'.format(filename, e))
+
+def burnIn(sensor, baseline, health):
+    print('Collecting gas resistance burn-in data for {} mins\n'.format(burn_in_time / 60))
+    end = time.monotonic() + burn_in_time
 
-            if sensor.get_sensor_data() and sensor.data.heat_stable:
+    def sample():
+        remain_time = int(end - time.monotonic())
+        print(f"Time remaining for sensor burn-in: {remain_time:2d}s", end='\r')
+        if readSensor(sensor, gas=True):
+            health.sample(counter='burn_in_samples')
+            if sensor.data.heat_stable:
                 gas = sensor.data.gas_resistance
-                burn_in_data.append(gas)
+                baseline.update(gas, burn_in=True)
                 #print('Gas: {} Ohms'.format(gas))
-                time.sleep(1)
-            gas_baseline = sum(burn_in_data[-50:]) / 50.0
 
-            hum_baseline = 40.0
+    scheduler = Scheduler()
+    scheduler.every('burn_in', burn_in_interval, sample)
+    scheduler.run(until=end)
 
-            hum_weighting = 0.25
+    #print('Gas Baseline: {} Ohms, humidity baseline: {:.2f} %RH\n'.format(baseline.value,hum_baseline))
+    baseline.save_if_due()
 
-            #print('Gas Baseline: {} Ohms, humidity baseline: {:.2f} %RH\n'.format(gas_baseline,hum_baseline))
+def getSensorData():
+    arbiter = BusArbiter('i2c-{}'.format(i2c_bus), i2c_lock_dir)
+    sensor = setupSensor(arbiter)
 
-        print('Polling sensor data')
+    health = SensorHealth(sensor_type, software_version, min(gas_interval, thp_interval),
+                          arbiter=arbiter, publisher=publisher, counters=('burn_in_samples',))
+    publisher.on_post = health.published
+    if health_port:
+        serve(health, health_port)
+
+    # A recently saved baseline makes burn-in unnecessary
+    baseline = GasBaseline(baseline_file, adapt_alpha=baseline_adapt_alpha, max_age=baseline_max_age)
 
-        output = {}
-        while True:
-            
-            if type(output) is str:
-                output = output.replace("\'", "\"")
-                output = json.loads(output)
-
-            if 'temperature_c' in output.keys():
-                print(f"Sensor Type: {output['sensor_type']}", end='\n')
-                print(f"Reading Time: {output['local_time']}", end='\n')
-                print(f"Temperature: {output['temperature_c']} C / {output['temperature_f']} F", end='\n')
-                print(f"Air Pressure: {output['pressure']} hPA", end='\n')
-                print(f"Humidity: {output['humidity']} %RH", end='\n')
-                print(f"Air Quality Score: {output['air_quality_score']:.2f}", end='\n')
-                print(f"\n")
+    def sampleThp():
+        if readSensor(sensor, gas=False):
+            health.sample()
+            output = thpReading(sensor)
+            printReading(output)
+            publish(output)
+
+    def sampleGas():
+        if readSensor(sensor, gas=True):
+            health.sample()
+            output = thpReading(sensor)
+            # After a burst the first read can still be the last profile's
+            if sensor.data.heat_stable and sensor.data.gas_index == 0:
+                gas = sensor.data.gas_resistance
+                gas_baseline = baseline.update(gas)
+                baseline.save_if_due()
+                output.update(airQuality(gas, gas_baseline, sensor.data.humidity))
+                if len(heater_profiles) > 1:
+                    readHeaterProfiles(sensor, output)
             else:
-                print('Loading initial readings\n')
-                print('\n')
-            try:
-                if sensor.get_sensor_data():
-                    
-                    output["sensor_type"] = sensor_type
-                    output["local_time"] = localTime()
-                    temp_c = '{:.2f}'.format(sensor.data.temperature)
-                    temp_f = '{:.2f}'.format(sensor.data.temperature * 1.8 + 32)
-                    press = '{:.2f}'.format(sensor.data.pressure)
-                    humid = '{:.2f}'.format(sensor.data.humidity)
-                    output["temperature_c"] = float(temp_c)
-                    output["temperature_f"] = float(temp_f)
-                    output["pressure"] = float(press)
-                    output["humidity"] = float(humid)
-
-                    if sensor.data.heat_stable:
-                        gas = sensor.data.gas_resistance
-                        gas_offset = gas_baseline - gas
-
-                        hum = sensor.data.humidity
-                        hum_offset = hum - hum_baseline
-
-                        if hum_offset > 0:
-                            hum_score = (100 - hum_baseline - hum_offset)
-                            hum_score /= (100 - hum_baseline)
-                            hum_score *= (hum_weighting * 100)
-                        
-                        else:
-                            hum_score = (hum_baseline + hum_offset)
-                            hum_score /= hum_baseline
-                            hum_score *= (hum_weighting * 100)
-                        
-                        if gas_offset > 0:
-                            gas_score = (gas / gas_baseline)
-                            gas_score *= (100 - (hum_weighting * 100))
-
-                        else:
-                            gas_score = 100 - (hum_weighting * 100)
-
-                        # Calculate air_quality_score.
-                        air_quality_score = hum_score + gas_score
-
-                        output["gas_resistance"] = float(gas)
-                        output["air_quality_score"] = air_quality_score
-                        output["gas_score"] = gas_score
-                        output["gas_baseline"] = gas_baseline
-                        output["gas_offset"] = gas_offset
-                        output["hum_score"] = hum_score
-                        output["hum_baseline"] = hum_baseline
-                        output["hum_offset"] = hum_offset
-                        output = str(output)
-                        print('gas stabilized output: {}'.format(output))
-                        publish(output)
-
-                    else:
-                        output = str(output)
-                        print('gas not stabilized output: {}'.format(output))
-                        publish(output)
-
-                time.sleep(10)
-            
-            except Exception as e:
-                print(e)
+                print('gas not stabilized')
+            printReading(output)
+            publish(output)
+
+    try:
+        if not baseline.load():
+            burnIn(sensor, baseline, health)
+
+        print('Polling sensor data')
+
+        # With equal cadences one gas sample covers T/P/H as well
+        scheduler = Scheduler()
+        health.details = lambda: {'timing': scheduler.stats()}
+        scheduler.every('gas', gas_interval, sampleGas)
+        if thp_interval != gas_interval:
+            scheduler.every('thp', thp_interval, sampleThp)
+        scheduler.every('node_specs', node_specs_interval, lambda: writeNodeSpecs(scheduler, health))
+        scheduler.run()
 
     except KeyboardInterrupt:
         pass
@@ -178,4 +308,4 @@ def getSensorData(last_update):
         print(e)
 
 if __name__ == "__main__":
-    getSensorData(last_update)
\ No newline at end of file
+    getSensorData()
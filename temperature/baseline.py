@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+
+# Streaming gas resistance baseline for the air quality score
+#
+# The baseline is an exponentially weighted moving average of heat-stable gas
+# resistance readings. The first `window` samples are averaged equally, after
+# which burn-in samples are weighted 2/(window+1), like the mean of the last
+# `window` samples it replaces. After burn-in it keeps following the sensor at
+# adapt_alpha per sample, slowly enough that a spell of bad air doesn't become
+# the new normal. It is saved to disk every save_interval seconds so a restart
+# within max_age of the last save can skip burn-in.
+
+import json
+import os
+import time
+
+
+class GasBaseline(object):
+
+    def __init__(self, path, window=50, adapt_alpha=0.001, max_age=86400, save_interval=300):
+        self.path = path
+        self.window = window
+        self.adapt_alpha = adapt_alpha
+        self.max_age = max_age
+        self.save_interval = save_interval
+
+        self.value = None
+        self.samples = 0
+        self._saved_at = 0.0
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                saved = json.load(f)
+            age = time.time() - saved['updated_at']
+            if age > self.max_age:
+                print('Saved gas baseline is {:.0f}s old, ignoring it'.format(age))
+                return False
+            self.value = float(saved['value'])
+            self.samples = int(saved['samples'])
+        except FileNotFoundError:
+            return False
+        except (ValueError, KeyError, TypeError) as e:
+            print('Could not read saved gas baseline: {}'.format(e))
+            return False
+        print('Loaded gas baseline {:.0f} Ohms from {} samples'.format(self.value, self.samples))
+        return True
+
+    def update(self, gas, burn_in=False):
+        self.samples += 1
+        if burn_in and self.samples <= self.window:
+            alpha = 1.0 / self.samples
+        elif burn_in:
+            alpha = 2.0 / (self.window + 1)
+        else:
+            alpha = self.adapt_alpha
+        if self.value is None:
+            self.value = float(gas)
+        else:
+            self.value += alpha * (gas - self.value)
+        return self.value
+
+    def save(self):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'value': self.value, 'samples': self.samples, 'updated_at': time.time()}, f)
+        os.replace(tmp, self.path)
+        self._saved_at = time.monotonic()
+
+    def save_if_due(self):
+        if self.value is not None and time.monotonic() - self._saved_at >= self.save_interval:
+            try:
+                self.save()
+            except OSError as e:
+                print('Could not save gas baseline: {}'.format(e))
+                self._saved_at = time.monotonic()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+
+# Simulated BME680 for running the service without the sensor
+#
+# SimBME680 has the parts of bme680.BME680 that app.py uses. Each
+# get_sensor_data() takes the next record of a trace (JSON lines with
+# temperature, pressure, humidity, gas_resistance and heat_stable, as written
+# by RecordingBME680), looping at the end, or without a trace makes up a
+# reading as a slow random walk. It never sleeps, so it runs as fast as the
+# app asks; app.py divides its sampling intervals by SIM_SPEED.
+
+import json
+import random
+
+
+def loadTrace(path):
+    with open(path) as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    if not records:
+        raise ValueError('{} has no records'.format(path))
+    return records
+
+
+class SimData(object):
+    __slots__ = ('temperature', 'pressure', 'humidity', 'gas_resistance', 'heat_stable', 'gas_index')
+
+    def __init__(self):
+        self.temperature = 21.0
+        self.pressure = 1013.0
+        self.humidity = 40.0
+        self.gas_resistance = 0.0
+        self.heat_stable = False
+        self.gas_index = 0
+
+
+class SimBME680(object):
+
+    def __init__(self, trace=None, seed=None):
+        self.data = SimData()
+        self._records = loadTrace(trace) if trace else None
+        self._index = 0
+        self._random = random.Random(seed)
+        self._gas = True
+        self._profiles = {0: (320, 150)}
+        self._profile = 0
+        # Clean air resistance at 320C; hotter profiles read lower
+        self._gas_resistance = 150000.0
+
+    def set_humidity_oversample(self, value):
+        pass
+
+    def set_pressure_oversample(self, value):
+        pass
+
+    def set_temperature_oversample(self, value):
+        pass
+
+    def set_filter(self, value):
+        pass
+
+    def set_gas_status(self, value):
+        # bme680.DISABLE_GAS_MEAS is 0
+        self._gas = value != 0
+
+    def set_gas_heater_profile(self, temperature, duration, nb_profile=0):
+        self._profiles[nb_profile] = (temperature, duration)
+
+    def select_gas_heater_profile(self, value):
+        self._profile = value
+
+    def get_sensor_data(self):
+        data = self.data
+        if self._records is not None:
+            record = self._records[self._index % len(self._records)]
+            self._index += 1
+            data.temperature = float(record['temperature'])
+            data.pressure = float(record['pressure'])
+            data.humidity = float(record['humidity'])
+            data.gas_resistance = float(record.get('gas_resistance', 0.0))
+            data.heat_stable = bool(record.get('heat_stable', True))
+        else:
+            walk = self._random.gauss
+            data.temperature = min(35.0, max(10.0, data.temperature + walk(0, 0.05)))
+            data.pressure = min(1050.0, max(950.0, data.pressure + walk(0, 0.1)))
+            data.humidity = min(90.0, max(15.0, data.humidity + walk(0, 0.2)))
+            self._gas_resistance = min(400000.0, max(20000.0, self._gas_resistance * (1 + walk(0, 0.01))))
+            temperature = self._profiles.get(self._profile, (320, 150))[0]
+            data.gas_resistance = self._gas_resistance * 320.0 / temperature
+            data.heat_stable = True
+        data.gas_index = self._profile
+        if not self._gas:
+            data.gas_resistance = 0.0
+            data.heat_stable = False
+        return True
+
+
+class RecordingBME680(object):
+    # Wraps a real bme680.BME680 and appends every reading to a trace that
+    # SimBME680 can replay
+
+    def __init__(self, sensor, path):
+        self._sensor = sensor
+        self._trace = open(path, 'a')
+
+    def __getattr__(self, name):
+        return getattr(self._sensor, name)
+
+    def get_sensor_data(self):
+        ok = self._sensor.get_sensor_data()
+        if ok:
+            data = self._sensor.data
+            record = {
+                'temperature': data.temperature,
+                'pressure': data.pressure,
+                'humidity': data.humidity,
+                'gas_resistance': data.gas_resistance,
+                'heat_stable': bool(data.heat_stable),
+            }
+            self._trace.write(json.dumps(record) + '\n')
+            self._trace.flush()
+        return ok